@@ -1,20 +1,38 @@
 #!/usr/bin/python3 -O
 """Capture images for testing and offline streaming."""
 
+import concurrent.futures
 # import pdb
+from typing import Optional
 
 from Code.Server import balparda_car as car
+from Code.Server import balparda_imaging as imaging
 
 _TEMPLATE = 'testimg/capture-001-%03d.jpg'
 
 
+def _Save(img: imaging.Image, path: str) -> str:
+  """Save `img` to `path`, return `path`."""
+  img.Save(path)
+  return path
+
+
 def main() -> None:
   """Execute main method."""
-  with car.Cam() as cam:
-    for n, (img, _) in enumerate(cam.Stream()):
-      path = _TEMPLATE % n
-      img.Save(path)
-      print('Saved: %r' % path)
+  # JPEG encoding (Save) runs in a worker, overlapping with the capture of the next frame;
+  # at most one save is in flight, so if saving is the slowest part capture waits for it
+  saving: Optional[concurrent.futures.Future] = None
+  with car.Cam() as cam, concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+    try:
+      for n, (img, _) in enumerate(cam.Stream()):
+        if saving is not None:
+          done, saving = saving, None
+          print('Saved: %r' % done.result())
+        # the streamed image is only valid until the next frame: the worker needs its own copy
+        saving = pool.submit(_Save, img.Copy(), _TEMPLATE % n)
+    finally:
+      if saving is not None:  # the last image (still saving when the stream ends, or a Ctrl-C)
+        print('Saved: %r' % saving.result())
 
 
 if __name__ == '__main__':
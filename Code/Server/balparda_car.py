@@ -1,14 +1,20 @@
 """Balparda's car API."""
 
-import io
+import collections
 import logging
+import mmap
 import multiprocessing
 import multiprocessing.sharedctypes
+import multiprocessing.util
 # import pdb
+import statistics
+import threading
 import time
-from typing import Dict, Iterator, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np  # type: ignore
 import picamera  # type: ignore
+import picamera.array  # type: ignore
 
 from Code.Server import ADC
 from Code.Server import Buzzer
@@ -22,15 +28,81 @@ from Code.Server import balparda_lib as lib
 from Code.Server import balparda_imaging as imaging
 
 
+class _AdcCache():
+  """ADC.Adc() wrapper that caches each channel reading for a short while (same interface).
+
+  Every ADC.Adc.recvADC() call is a few serialized I2C round-trips, and battery & photoresistor
+  readings don't change meaningfully faster than the sensor noise. Use Get() for the instance that
+  all ADC users in the process share.
+  """
+
+  __slots__ = ('_a', '_values', '_times')
+
+  _TTL = 0.05  # seconds
+  _N_CHANNELS = 4
+  _INSTANCE: Optional['_AdcCache'] = None
+
+  @classmethod
+  def Get(cls) -> '_AdcCache':
+    """Get the (process-wide) ADC cache instance."""
+    if cls._INSTANCE is None:
+      cls._INSTANCE = cls()
+    return cls._INSTANCE
+
+  def __init__(self) -> None:
+    """Create object. Prefer Get() for the shared instance."""
+    self._a = ADC.Adc()
+    self._values = [0.0] * _AdcCache._N_CHANNELS
+    self._times = [-_AdcCache._TTL] * _AdcCache._N_CHANNELS  # monotonic time of last reading
+
+  def recvADC(self, channel: int) -> float:
+    """Return float reading for `channel`, in volts, reading ADC only if cached value is old."""
+    now = time.monotonic()
+    if now - self._times[channel] >= _AdcCache._TTL:
+      if self._a.Index == 'PCF8591':
+        self._ReadBurst(now)  # all channels cost the same as one, so refresh them all
+      else:
+        self._values[channel] = self._a.recvADC(channel)
+        self._times[channel] = now
+    return self._values[channel]
+
+  def ReadAll(self) -> Tuple[float, float, float, float]:
+    """Return float readings for all 4 channels, in volts, as a tuple."""
+    return (self.recvADC(0), self.recvADC(1), self.recvADC(2), self.recvADC(3))
+
+  _PCF8591_AUTO_INCREMENT = 0x04  # control byte flag: read channels 0, 1, 2, 3 in sequence
+  _PCF8591_BURSTS = 9  # ADC.Adc takes the median of 9 reads per channel, so do we
+  _PCF8591_VOLTS = 3.3
+
+  def _ReadBurst(self, now: float) -> None:
+    """Read all PCF8591 channels with block reads (auto-increment), instead of channel by channel.
+
+    ADC.Adc.recvPCF8591() does (at least) 18 single byte I2C transactions per channel; this does
+    _PCF8591_BURSTS transactions for all 4 channels and takes the per channel median (which also
+    takes care of the noise, as ADC.Adc does). In each burst the first byte is the result of the
+    previous conversion, so it is discarded.
+    """
+    bus, address = self._a.bus, self._a.ADDRESS
+    command = self._a.PCF8591_CMD | _AdcCache._PCF8591_AUTO_INCREMENT
+    bursts = [bus.read_i2c_block_data(address, command, _AdcCache._N_CHANNELS + 1)[1:]
+              for _ in range(_AdcCache._PCF8591_BURSTS)]
+    for channel, samples in enumerate(zip(*bursts)):
+      self._values[channel] = round(
+          statistics.median_low(samples) / 256.0 * _AdcCache._PCF8591_VOLTS, 2)
+      self._times[channel] = now
+
+
 class Battery():
   """Car battery functionality wrapper."""
 
+  __slots__ = ('_a',)
+
   _BATTERY_FACTOR = 3.0
   _BATTERY_INDEX = 3
 
   def __init__(self) -> None:
     """Create object."""
-    self._a = ADC.Adc()
+    self._a = _AdcCache.Get()
 
   def Read(self) -> float:
     """Return float batery reading, in volts."""
@@ -48,11 +120,13 @@ class Battery():
 class Photoresistor():
   """Car photoresistor functionality wrapper."""
 
+  __slots__ = ('_a',)
+
   _PHOTO_INDEX = (0, 1)
 
   def __init__(self) -> None:
     """Create object."""
-    self._a = ADC.Adc()
+    self._a = _AdcCache.Get()
 
   def Read(self) -> Tuple[float, float]:
     """Return left & right (left_float, right_float) photoresistor reading."""
@@ -71,53 +145,151 @@ class Photoresistor():
 class Engine():
   """Car engine (movement) functionality wrapper."""
 
+  __slots__ = ('_m', '_set_motors', '_motors_until')
+
   _GAIN = 400
+  _MAX_SPEED = 10
+  _GAIN_TABLE = dict(zip(  # speed -> duty, for integer speeds (same as round(_GAIN * speed))
+      range(-_MAX_SPEED, _MAX_SPEED + 1),
+      range(-_MAX_SPEED * _GAIN, (_MAX_SPEED + 1) * _GAIN, _GAIN)))
+  _STOP = (0, 0, 0, 0)
+  _TURN_TIME_PER_DEGREE = 0.7 / 90.0  # seconds; calibrated for 90 degree turns (see Turn())
 
   def __init__(self) -> None:
     """Create object."""
     self._m = Motor.Motor()
+    self._set_motors = self._m.setMotorModel  # bound once: Move() is called from control loops
+    self._motors_until: Optional[float] = None  # time.monotonic() time to stop, see Start()
 
   def Move(self,
            left_upper: float,
            left_lower: float,
            right_upper: float,
            right_lower: float,
-           tm: float) -> None:
+           tm: float,
+           start_time: Optional[float] = None) -> float:
     """Move car wheels for a certain time. Will block.
 
     Args:
-      left_upper: Speed to apply to upper left wheel, int, -10.0 to 10.0
-      left_lower: Speed to apply to lower left wheel, int, -10.0 to 10.0
-      right_upper: Speed to apply to upper right wheel, int, -10.0 to 10.0
-      right_lower: Speed to apply to lower right wheel, int, -10.0 to 10.0
+      left_upper: Speed to apply to upper left wheel, float, -10.0 to 10.0
+      left_lower: Speed to apply to lower left wheel, float, -10.0 to 10.0
+      right_upper: Speed to apply to upper right wheel, float, -10.0 to 10.0
+      right_lower: Speed to apply to lower right wheel, float, -10.0 to 10.0
       tm: Time to apply motors, in seconds.
+      start_time: (default None, meaning now) The time.monotonic() time the movement is counted
+          from; pass the return of the previous move to chain movements without drift
+
+    Returns:
+      the time.monotonic() deadline the movement ended at
     """
     try:
-      self._m.setMotorModel(round(Engine._GAIN * left_upper),
-                            round(Engine._GAIN * left_lower),
-                            round(Engine._GAIN * right_upper),
-                            round(Engine._GAIN * right_lower))
-      time.sleep(tm)
+      deadline = self.Start(
+          left_upper, left_lower, right_upper, right_lower, tm, start_time=start_time)
+      lib.SleepUntil(deadline)
     finally:
-      self._m.setMotorModel(0, 0, 0, 0)
+      self.Stop()
+    return deadline
+
+  def MoveSequence(self,
+                   moves: Iterable[Tuple[float, float, float, float, float]],
+                   start_time: Optional[float] = None) -> float:
+    """Do a sequence of wheel movements back to back, stopping only at the end. Will block.
+
+    Unlike chained Move() calls, the wheels are not stopped between movements (which would be an
+    extra motor command each time, and a jolt through speed zero for nothing).
+
+    Args:
+      moves: like [(left_upper, left_lower, right_upper, right_lower, tm), ...], see Move()
+      start_time: (default None, meaning now) The time.monotonic() time the first movement is
+          counted from, see Move()
+
+    Returns:
+      the time.monotonic() deadline the last movement ended at
+    """
+    deadline = time.monotonic() if start_time is None else start_time
+    try:
+      for left_upper, left_lower, right_upper, right_lower, tm in moves:
+        deadline = self.Start(
+            left_upper, left_lower, right_upper, right_lower, tm, start_time=deadline)
+        lib.SleepUntil(deadline)
+    finally:
+      self.Stop()
+    return deadline
+
+  def Start(self,
+            left_upper: float,
+            left_lower: float,
+            right_upper: float,
+            right_lower: float,
+            tm: float,
+            start_time: Optional[float] = None) -> float:
+    """Start car wheels for a certain time, like Move(), but WITHOUT blocking.
+
+    The wheels keep going until Tick() is called after the time is up (or Stop() is called), so
+    the caller must call Tick() often, for example at the top of each control loop iteration.
+
+    Returns:
+      the time.monotonic() deadline the movement should end at
+    """
+    deadline = (time.monotonic() if start_time is None else start_time) + tm
+    speeds = (left_upper, left_lower, right_upper, right_lower)
+    duties = tuple(map(Engine._Duty, speeds))
+    self._set_motors(*duties)
+    self._motors_until = deadline
+    return deadline
+
+  def Tick(self) -> bool:
+    """Stop the wheels if the time given to Start() is up.
+
+    Returns:
+      True if the wheels are still moving, False if they are stopped
+    """
+    if self._motors_until is None:
+      return False
+    if time.monotonic() < self._motors_until:
+      return True
+    self.Stop()
+    return False
+
+  def Stop(self) -> None:
+    """Stop the wheels now."""
+    self._set_motors(*Engine._STOP)
+    self._motors_until = None
+
+  @staticmethod
+  def _Duty(speed: float) -> int:
+    """Convert a speed (-10.0 to 10.0) into a motor duty: whole speeds are a table lookup."""
+    duty = Engine._GAIN_TABLE.get(speed)  # 1.0 finds 1 too, as they hash (and compare) equal
+    if duty is not None:
+      return duty
+    if abs(speed) > Engine._MAX_SPEED:
+      raise Exception('Invalid speed %r, must be in [-10, 10]' % speed)
+    return round(Engine._GAIN * speed)
+
+  def Straight(self, speed: float, tm: float, start_time: Optional[float] = None) -> float:
+    """Move car ahead at `speed` for `tm` seconds. Will block.
 
-  def Straight(self, speed: float, tm: float) -> None:
-    """Move car ahead at `speed` for `tm` seconds. Will block."""
+    Returns:
+      the time.monotonic() deadline the movement ended at (see `start_time` in Move())
+    """
     logging.info('Move at speed %0.2f for %0.2f seconds', speed, tm)
-    self.Move(speed, speed, speed, speed, tm)
+    return self.Move(speed, speed, speed, speed, tm, start_time=start_time)
 
-  def Turn(self, angle: int) -> None:
+  def Turn(self, angle: int, start_time: Optional[float] = None) -> float:
     """Turn car by `angle`. Will block until done.
 
     Works best when angle is +90 or -90 as car is actually non-linear.
+
+    Returns:
+      the time.monotonic() deadline the movement ended at (see `start_time` in Move())
     """
     angle = lib.MinAngle(angle)
     logging.info('Turn %d degrees', angle)
-    tm = abs(angle * (.7/90))
+    tm = abs(angle) * Engine._TURN_TIME_PER_DEGREE
     if angle > 0:
-      self.Move(5, 5, -4, -4, tm)
+      return self.Move(5, 5, -4, -4, tm, start_time=start_time)
     else:
-      self.Move(-4, -4, 5, 5, tm)
+      return self.Move(-4, -4, 5, 5, tm, start_time=start_time)
 
 
 class Noise():
@@ -156,19 +328,27 @@ class Light():
   def __enter__(self) -> 'Light':
     """Enter context: turn on the leds."""
     logging.info('Lights @ %r', self._dict)
+    # set all pixels first and then show() only once: Led.ledIndex() would show() for every led
     for n, (r, g, b) in self._dict.items():
-      self._l.ledIndex(1 << n, r, g, b)
+      self._l.strip.setPixelColor(n, self._l.LED_TYPR(self._l.ORDER, Led.Color(r, g, b)))
+    self._l.strip.show()
     return self
 
   def __exit__(self, a, b, c) -> None:
     """Leave context: turn leds off."""
-    self._l.colorWipe(self._l.strip, Led.Color(0, 0, 0))  # type: ignore
+    # Led.colorWipe() would show() and sleep 50ms for every led in the strip; do it all at once
+    strip, off = self._l.strip, self._l.LED_TYPR(self._l.ORDER, Led.Color(0, 0, 0))
+    for n in range(strip.numPixels()):
+      strip.setPixelColor(n, off)
+    strip.show()
     logging.info('Lights off')
 
 
 class Sonar():
   """Car sonar (distance detection) functionality wrapper."""
 
+  __slots__ = ('_s',)
+
   def __init__(self) -> None:
     """Create object."""
     self._s = Ultrasonic.Ultrasonic()
@@ -177,6 +357,30 @@ class Sonar():
     """Return float distance reading, in meters."""
     return self._s.get_distance() / 100.0
 
+  _ECHO_TIMEOUT = 10000     # busy-wait loop iterations, same as in Ultrasonic.get_distance()
+  _CM_PER_SECOND = 1.0 / 0.000058  # round-trip pulse length to distance, ditto
+
+  def ReadMany(self, n: int = 5) -> float:
+    """Return float distance reading, in meters, as the median of `n` back-to-back pulses.
+
+    Each Read() is already 3 pulses plus their Python overhead; this times the pulses directly,
+    so a control loop gets a better denoised reading for about the same time.
+
+    Args:
+      n: (default 5) Number of pulses to issue; odd numbers make for a true median
+    """
+    if n < 1:
+      raise Exception('Need at least 1 pulse, got %r' % n)
+    s, timeout, now = self._s, Sonar._ECHO_TIMEOUT, time.perf_counter
+    pulses = [0.0] * n
+    for i in range(n):
+      s.send_trigger_pulse()
+      s.wait_for_echo(True, timeout)
+      start = now()
+      s.wait_for_echo(False, timeout)
+      pulses[i] = now() - start
+    return statistics.median(pulses) * Sonar._CM_PER_SECOND / 100.0
+
   def __str__(self) -> str:
     """Print human readable distance reading."""
     return "Distance: %0.3f meters" % self.Read()
@@ -189,6 +393,11 @@ class Sonar():
 class Neck():
   """Car neck and head movement functionality wrapper."""
 
+  __slots__ = ('_s', '_pos', '_o')
+
+  _H_MIN, _H_MAX = -70, 70  # degrees
+  _V_MIN, _V_MAX = -20, 70  # degrees
+
   def __init__(self, offset: Tuple[int, int] = (0, 0)) -> None:
     """Create object.
 
@@ -210,39 +419,95 @@ class Neck():
     """Leave context: reset neck to center."""
     self.Zero()
 
-  def Set(self, h: int, v: int) -> None:
-    """Set neck to a position.
+  def Set(self, h: int, v: int, slew: bool = True) -> float:
+    """Set neck to a position. Will block until done, if `slew`.
 
     Args:
       h: horizontal angle, in degrees
       v: vertical angle, in degrees
+      slew: (default True) If True moves the servos _MAX_STEP degrees at a time (see SetSteps());
+          if False sends the final position to the servos at once and returns right away,
+          leaving it to the servos to get there at their own speed
+
+    Returns:
+      the time.monotonic() time the neck should be settled at (already past, if `slew`)
     """
-    h, v = lib.MinAngle(h), lib.MinAngle(v)
-    if h < -70: h = -70  # noqa: E701
-    if h > 70:  h = 70   # noqa: E701
-    if v < -20: v = -20  # noqa: E701
-    if v > 70:  v = 70   # noqa: E701
-    logging.info('Neck to position %s', Neck._NECK_POSITION_STR((h, v)))
-    self._Set(h, v)
+    deadline = time.monotonic()
+    if slew:
+      for deadline in self.SetSteps(h, v):
+        lib.SleepUntil(deadline, spin=Neck._STEP_SPIN)
+      return deadline
+    h, v = self._Clamp(h, v)
+    logging.info('Neck to position ' + Neck._POSITION_FORMAT, h, v)  # formats only if logged
+    travel = max(abs(h - self._pos[0]), abs(v - self._pos[1]))
+    self._Write(h, v)
+    return deadline + travel * Neck._SERVO_TIME_PER_DEGREE
+
+  def SetSteps(self, h: int, v: int) -> Iterator[float]:
+    """Set neck to a position, one _MAX_STEP degrees step per iteration. Will not block.
+
+    The caller is the one that waits between steps, so it can do something else meanwhile
+    (like reading the sonar) and just pump this iterator when due. Set() does exactly that.
+
+    Args:
+      h: horizontal angle, in degrees
+      v: vertical angle, in degrees
+
+    Yields:
+      after each step, the time.monotonic() time the next step is due (the last one is when the
+      neck should be settled)
+    """
+    h, v = self._Clamp(h, v)
+    logging.info('Neck to position ' + Neck._POSITION_FORMAT, h, v)  # formats only if logged
+    return self._Steps(h, v)
+
+  @staticmethod
+  def _Clamp(h: int, v: int) -> Tuple[int, int]:
+    return (max(Neck._H_MIN, min(Neck._H_MAX, lib.MinAngle(h))),
+            max(Neck._V_MIN, min(Neck._V_MAX, lib.MinAngle(v))))
 
   _MAX_STEP = 3
+  _STEP_TIME = 0.02  # seconds
+  _STEP_SPIN = 0.002  # seconds of each step wait that are busy-waited, for a smoother slew
+  _SERVO_TIME_PER_DEGREE = 0.2 / 60.0  # seconds; servos at their own speed, with some margin
 
-  def _Set(self, h: int, v: int) -> None:
+  @staticmethod
+  def _Trajectory(start: int, end: int, n_steps: int) -> np.ndarray:
+    """Waypoints from `start` (excluded) to `end` (included), moving at most _MAX_STEP per step.
+
+    Will have `n_steps` waypoints; if `end` is reached early, the last waypoints repeat `end`.
+    """
+    delta = end - start
+    return start + np.sign(delta) * np.minimum(
+        np.arange(1, n_steps + 1) * Neck._MAX_STEP, abs(delta))
+
+  def _Write(self, h: int, v: int) -> None:
+    self._s.setServoPwm('0', h + self._o[0] + 90)
+    self._s.setServoPwm('1', v + self._o[1] + 90)
+    self._pos = (h, v)
+
+  def _Steps(self, h: int, v: int) -> Iterator[float]:
     new_pos = (int(round(h)), int(round(v)))
-    while self._pos[0] != new_pos[0] or self._pos[1] != new_pos[1]:
-      hd, vd = new_pos[0] - self._pos[0], new_pos[1] - self._pos[1]
-      if abs(hd) > Neck._MAX_STEP:
-        hd = Neck._MAX_STEP if hd > 0 else -Neck._MAX_STEP
-      if abs(vd) > Neck._MAX_STEP:
-        vd = Neck._MAX_STEP if vd > 0 else -Neck._MAX_STEP
-      self._pos = (self._pos[0] + hd, self._pos[1] + vd)
-      self._s.setServoPwm('0', self._pos[0] + self._o[0] + 90)
-      self._s.setServoPwm('1', self._pos[1] + self._o[1] + 90)
-      time.sleep(0.02)
+    n_steps = -(-max(abs(new_pos[0] - self._pos[0]),  # ceil division
+                     abs(new_pos[1] - self._pos[1])) // Neck._MAX_STEP)
+    h_traj = Neck._Trajectory(self._pos[0], new_pos[0], n_steps).tolist()
+    v_traj = Neck._Trajectory(self._pos[1], new_pos[1], n_steps).tolist()
+    h_offset, v_offset = self._o[0] + 90, self._o[1] + 90
+    deadline = time.monotonic()
+    for hp, vp in zip(h_traj, v_traj):
+      self._s.setServoPwm('0', hp + h_offset)
+      self._s.setServoPwm('1', vp + v_offset)
+      self._pos = (hp, vp)
+      deadline += Neck._STEP_TIME
+      yield deadline
+
+  def _Set(self, h: int, v: int) -> None:
+    for deadline in self._Steps(h, v):
+      lib.SleepUntil(deadline, spin=Neck._STEP_SPIN)
 
   def Zero(self) -> None:
     """Return neck to central position."""
-    logging.info('Neck to ZERO/CENTER, offset=%s', Neck._NECK_POSITION_STR(self._o))
+    logging.info('Neck to ZERO/CENTER, offset=' + Neck._POSITION_FORMAT, *self._o)
     self._Set(0, 0)
 
   def Delta(self, h: int, v: int) -> None:
@@ -254,11 +519,15 @@ class Neck():
     """
     self.Set(self._pos[0] + h, self._pos[1] + v)
 
-  _NECK_POSITION_STR = lambda p: '(H: %+02d, V: %+02d) degrees' % p
+  _POSITION_FORMAT = '(H: %+02d, V: %+02d) degrees'
+
+  @staticmethod
+  def _PositionStr(p: Tuple[int, int]) -> str:
+    return Neck._POSITION_FORMAT % p
 
   def __str__(self) -> str:
     """Readable respresentation of neck position."""
-    return Neck._NECK_POSITION_STR(self._pos)
+    return Neck._PositionStr(self._pos)
 
   def Read(self) -> Tuple[int, int]:
     """Get current neck position (h_angle, v_angle) in degrees."""
@@ -268,15 +537,49 @@ class Neck():
 class Infra():
   """Car lower infra-red sensor functionality wrapper."""
 
+  __slots__ = ('_l', '_gpio', '_masks', '_all_mask', '_lmr')
+
+  # GPIO registers, as mapped by /dev/gpiomem (BCM2835 to BCM2711); all IR pins are in bank 0
+  _GPIOMEM = '/dev/gpiomem'
+  _GPIOMEM_SIZE = 4096  # bytes
+  _GPLEV0 = 0x34 // 4   # 32 bit word index of pin level register for GPIOs 0-31
+
   def __init__(self) -> None:
     """Create object."""
     self._l = Line_Tracking.Line_Tracking()
+    self._gpio: Optional[memoryview] = None  # GPIO registers as uint32 words, if we can map them
+    try:
+      with open(Infra._GPIOMEM, 'r+b') as gpiomem:
+        self._gpio = memoryview(mmap.mmap(gpiomem.fileno(), Infra._GPIOMEM_SIZE)).cast('I')
+    except (OSError, ValueError) as err:
+      logging.warning('Could not map %s, will read IR pins one by one: %s', Infra._GPIOMEM, err)
+    self._masks = (1 << self._l.IR01, 1 << self._l.IR02, 1 << self._l.IR03)  # (L, M, R) bits
+    self._all_mask = self._masks[0] | self._masks[1] | self._masks[2]
+    # masked register value -> LMR code, for all 8 combinations of the 3 pins
+    self._lmr = {(left * self._masks[0]) | (mid * self._masks[1]) | (right * self._masks[2]):
+                 (left << 2) | (mid << 1) | right
+                 for left in (0, 1) for mid in (0, 1) for right in (0, 1)}
 
   def Read(self) -> Tuple[bool, bool, bool]:
     """Return (left_bool, middle_bool, right_bool) infra-red reading."""
-    return (bool(Line_Tracking.GPIO.input(self._l.IR01)),
-            bool(Line_Tracking.GPIO.input(self._l.IR02)),
-            bool(Line_Tracking.GPIO.input(self._l.IR03)))
+    if self._gpio is None:
+      return (bool(Line_Tracking.GPIO.input(self._l.IR01)),
+              bool(Line_Tracking.GPIO.input(self._l.IR02)),
+              bool(Line_Tracking.GPIO.input(self._l.IR03)))
+    levels = self._gpio[Infra._GPLEV0]  # one register read for all pins
+    l_mask, m_mask, r_mask = self._masks
+    return (bool(levels & l_mask), bool(levels & m_mask), bool(levels & r_mask))
+
+  def ReadLMR(self) -> int:
+    """Return infra-red reading as a 3 bit int, left=4 | middle=2 | right=1 (as Line_Tracking).
+
+    For line tracking loops: compare against constants (like 2 for "only middle") instead of
+    unpacking Read()'s tuple; with the mapped registers this is one read, one mask and one lookup.
+    """
+    if self._gpio is None:
+      left, mid, right = self.Read()
+      return (left << 2) | (mid << 1) | right
+    return self._lmr[self._gpio[Infra._GPLEV0] & self._all_mask]
 
   def __str__(self) -> str:
     """Print human readable infra-red left, middle, and right reading."""
@@ -289,19 +592,85 @@ class Infra():
     return repr(self.Read())
 
 
+# the picamera.PiCamera shared by all Cam objects in the process (see Cam.__enter__())
+_PICAM: Optional[picamera.PiCamera] = None
+_PICAM_SETTINGS: Optional[Tuple[Tuple[int, int], int]] = None  # (resolution, framerate)
+_PICAM_READY_AT = 0.0  # time.monotonic() time when _PICAM will have settled
+_PICAM_REFS = 0        # Cam contexts currently using _PICAM
+_PICAM_LOCK = threading.Lock()
+
+
+class _LatestFrames(picamera.array.PiRGBAnalysis):
+  """Camera output that keeps only the freshest raw RGB frames, for Cam.StreamTo().
+
+  picamera calls analyze() from its own encoder callback thread (the single producer) and
+  Cam.StreamTo() pops from the other side (the single consumer); the deque is bounded, so if the
+  consumer falls behind the oldest frames are just dropped, never queued.
+  """
+
+  _DEPTH = 2  # frames
+
+  def __init__(self, camera: picamera.PiCamera) -> None:
+    """Create output object for `camera`."""
+    super().__init__(camera)
+    self._frames: collections.deque = collections.deque(maxlen=_LatestFrames._DEPTH)
+    self._lock = threading.Lock()
+    self._arrived = threading.Event()
+    self.dropped = 0
+
+  def analyze(self, array: np.ndarray) -> None:
+    """Receive one frame (called by picamera, in its thread); `array` is a new array per frame."""
+    with self._lock:
+      if len(self._frames) == self._frames.maxlen:
+        self.dropped += 1
+      self._frames.append(array)
+    self._arrived.set()
+
+  def Latest(self, timeout: float) -> Optional[np.ndarray]:
+    """Pop the freshest frame, discarding any older one.
+
+    Args:
+      timeout: Maximum time to wait for a frame to arrive, in seconds
+
+    Returns:
+      the frame as a (height, width, 3) array, or None if no frame arrived before `timeout`
+    """
+    if not self._arrived.wait(timeout):
+      return None
+    with self._lock:
+      self._arrived.clear()
+      if not self._frames:
+        return None
+      array = self._frames.pop()
+      self.dropped += len(self._frames)
+      self._frames.clear()
+    return array
+
+
 class Cam():
-  """Car camera functionality wrapper. This is a context object."""
+  """Car camera functionality wrapper. This is a context object.
+
+  Uses the legacy (MMAL) picamera stack, which is what Code/Patch/ sets the car up for
+  (`start_x=1` + patched libmmal); picamera2 needs the libcamera stack instead. Stream() and
+  Click() read raw RGB frames (the first from the video port), so no encoding happens on the CPU
+  for the imaging code.
+  """
+
+  __slots__ = (
+      '_c', '_resolution', '_framerate', '_shape', '_padded_shape', '_buf', '_mv', '_ready_at')
 
   # this is the size if you ask for a JPG; aspect is 4:3
   _WIDTH = 2592
   _HEIGHT = 1944
   _ASPECT = 4.0 / 3.0
   _DEFAULT_RESOLUTION = (800, 600)
-  _DEFAULT_FRAMERATE = 10
+  _DEFAULT_FRAMERATE = 30  # video port; the 20Hz decision loop then sees frames <33ms old
   _SLEEP_TO_INIT = 1.5
   _FOCAL_LENGTH = 3.60  # mm (https://www.raspberrypi.com/documentation/accessories/camera.html)
   _SENSOR_SIZE = (3.76, 2.74)     # mm
   _ANGLE_OF_VIEW = (53.50, 41.41)  # degrees
+  _RAW_ALIGNMENT = (32, 16)  # raw captures are padded to multiples of (width, height)
+  _STREAM_TIMEOUT_FRAMES = 5  # StreamTo() re-checks the stop flag at least every 5 frame times
 
   def __init__(self,
                resolution: Tuple[int, int] = _DEFAULT_RESOLUTION,
@@ -310,79 +679,248 @@ class Cam():
 
     Args:
       resolution: (default 800x600) like (width, height) as ints
-      framerate: (default 10) int framerate
+      framerate: (default 30) int framerate
     """
     self._c: picamera.Picamera
     self._c = None  # type: ignore
     self._resolution = resolution
     self._framerate = framerate
+    width, height = resolution
+    self._shape = (height, width, 3)
+    self._padded_shape = (  # raw captures are padded: round up to alignment
+        -(-height // Cam._RAW_ALIGNMENT[1]) * Cam._RAW_ALIGNMENT[1],
+        -(-width // Cam._RAW_ALIGNMENT[0]) * Cam._RAW_ALIGNMENT[0],
+        3)
+    self._buf: bytearray   # raw capture buffer, allocated once per context
+    self._mv: memoryview   # view of `self._buf`
+    self._buf, self._mv = None, None  # type: ignore
+    self._ready_at = 0.0   # time.monotonic() time when the camera will have settled
 
   def __enter__(self) -> 'Cam':
-    """Enter context: initialize the camera. ATTENTION: will block for 1.5 seconds."""
-    self._c = picamera.PiCamera(resolution=self._resolution, framerate=self._framerate)
-    logging.info(
-        'Starting camera with resolution %r and framerate %d (+wait %0.2fs)',
-        self._resolution, self._framerate, Cam._SLEEP_TO_INIT)
-    time.sleep(Cam._SLEEP_TO_INIT)
+    """Enter context: initialize the camera.
+
+    The underlying picamera.PiCamera is shared by all Cam contexts in the process and is only
+    created (and warmed up) on the first entry; it stays open when the contexts exit, so later
+    ones start right away, and is closed by Cam.Shutdown(), that also runs when the process exits
+    (the main process or a multiprocessing child: atexit alone does not run in the children, so
+    it is registered with multiprocessing.util.Finalize). All contexts in the process must thus
+    use the same resolution and framerate.
+
+    The camera needs 1.5 seconds to settle (AWB/AE) but this will not block: the wait happens,
+    if still needed, on the first Click() or Stream() call, so other hardware can be initialized
+    meanwhile.
+    """
+    global _PICAM, _PICAM_SETTINGS, _PICAM_READY_AT, _PICAM_REFS
+    settings = (self._resolution, self._framerate)
+    with _PICAM_LOCK:
+      if _PICAM is None:
+        _PICAM = picamera.PiCamera(resolution=self._resolution, framerate=self._framerate)
+        _PICAM_SETTINGS, _PICAM_READY_AT = settings, time.monotonic() + Cam._SLEEP_TO_INIT
+        multiprocessing.util.Finalize(None, Cam.Shutdown, kwargs={'force': True}, exitpriority=10)
+        logging.info(
+            'Starting camera with resolution %r and framerate %d (ready in %0.2fs)',
+            self._resolution, self._framerate, Cam._SLEEP_TO_INIT)
+      elif settings != _PICAM_SETTINGS:
+        raise Exception('Camera already open as %r, cannot use %r' % (_PICAM_SETTINGS, settings))
+      _PICAM_REFS += 1
+      self._c, self._ready_at = _PICAM, _PICAM_READY_AT
+    self._buf = bytearray(int(np.prod(self._padded_shape)))
+    self._mv = memoryview(self._buf)
     return self
 
   def __exit__(self, a, b, c) -> None:
-    """Leave context: close camera object."""
+    """Leave context: release camera object (it stays open for the next context)."""
+    global _PICAM_REFS
     if not self._c:
       raise Exception('Not initialized')
-    self._c.close()
+    with _PICAM_LOCK:
+      _PICAM_REFS -= 1
+    self._c = None  # type: ignore
+    self._buf, self._mv = None, None  # type: ignore
+    logging.info('Camera released')
+
+  @staticmethod
+  def Shutdown(force: bool = False) -> None:
+    """Close the shared camera, if open. Runs at process exit too (see __enter__()).
+
+    Args:
+      force: (default False) If True closes the camera even if some Cam is still in use (as is the
+          case at exit, if a Cam context never exited); if False that is an error
+    """
+    global _PICAM, _PICAM_SETTINGS
+    with _PICAM_LOCK:
+      if _PICAM is None:
+        return
+      if _PICAM_REFS:
+        if not force:
+          raise Exception('Camera still in use by %d context(s)' % _PICAM_REFS)
+        logging.warning('Closing camera still in use by %d context(s)', _PICAM_REFS)
+      _PICAM.close()
+      _PICAM, _PICAM_SETTINGS = None, None
     logging.info('Camera closed')
 
-  def Click(self) -> Tuple[imaging.Image, bytes]:
-    """Take a single image.
+  def Click(self) -> Tuple[imaging.Image, bytearray]:
+    """Take a single image, as raw RGB (no BMP/JPEG encoding and decoding is done).
 
     Returns:
-      (image_object, image_bytes)
+      (image_object, raw_rgb_buffer), where raw_rgb_buffer still has the alignment padding;
+      both are new objects, owned by the caller
     """
     if not self._c:
       raise Exception('Not initialized')
-    stream = io.BytesIO()
-    self._c.capture(stream, format='bmp')
-    stream.seek(0)
-    data = stream.read()
-    img = imaging.Image(data)
+    lib.SleepUntil(self._ready_at)
+    data = bytearray(len(self._buf))
+    self._c.capture(data, format='rgb')
+    img = imaging.Image.FromRaw(data, self._shape, padded_shape=self._padded_shape)
     return (img, data)
 
-  def Stream(self) -> Iterator[Tuple[imaging.Image, bytes]]:
-    """Stream images.
+  def ClickBatch(self, n: int) -> Tuple[List[imaging.Image], np.ndarray]:
+    """Take `n` images in a quick sequence, as raw RGB, into a single preallocated array.
+
+    Uses picamera's capture_sequence() from the video port, so the camera is set up only once
+    for the whole batch (instead of once per Click()); good for multi-frame processing, like a
+    temporal median to denoise, which can then work on the batch array along its first axis.
+
+    Args:
+      n: number of images to take
+
+    Returns:
+      ([image_object, ...], raw_rgb_batch), where raw_rgb_batch is a (n, height, width, 3)
+      np.uint8 array that still has the alignment padding, and each image is a view into it;
+      all are new objects, owned by the caller
+    """
+    if not self._c:
+      raise Exception('Not initialized')
+    if n < 1:
+      raise Exception('Batch must have at least 1 image (got %d)' % n)
+    lib.SleepUntil(self._ready_at)
+    batch = np.empty((n,) + self._padded_shape, dtype=np.uint8)
+    self._c.capture_sequence(
+        [memoryview(frame).cast('B') for frame in batch], format='rgb', use_video_port=True)
+    images = [imaging.Image.FromRaw(frame, self._shape, padded_shape=self._padded_shape)
+              for frame in batch]
+    return (images, batch)
+
+  def ClickGrey(self) -> imaging.Image:
+    """Take a single greyscale image, straight from the Y (luma) plane of a raw YUV capture.
+
+    No RGB conversion is done, neither by the camera nor by Image.Grey(): the Y plane already is
+    the uint8 greyscale image, with the same alignment padding as the raw RGB captures. Uses the
+    video port, like Stream(), so there is no mode switch for the capture.
+
+    Returns:
+      greyscale image_object, a new object owned by the caller
+    """
+    if not self._c:
+      raise Exception('Not initialized')
+    lib.SleepUntil(self._ready_at)
+    padded_height, padded_width, _ = self._padded_shape
+    data = bytearray(padded_height * padded_width * 3 // 2)  # YUV420: Y plane + 2 quarter planes
+    self._c.capture(data, format='yuv', use_video_port=True)
+    return imaging.Image.FromRaw(
+        data, self._shape[:2], padded_shape=(padded_height, padded_width))
+
+  def Stream(self) -> Iterator[Tuple[imaging.Image, memoryview]]:
+    """Stream raw RGB images from the video port (no BMP/JPEG encoding is done).
+
+    ATTENTION: the yielded image is a view over a capture buffer that is reused for every frame,
+    so it is only valid until the next iteration; call `img.Copy()` to keep it for longer.
 
     Yields:
-      (image_object, image_bytes)
+      (image_object, raw_rgb_buffer), where raw_rgb_buffer still has the alignment padding
     """
-    stream = io.BytesIO()
-    logging.info('Camera taking continuous bmp images')
-    for _ in self._c.capture_continuous(stream, format='bmp'):
-      stream.truncate()  # in case prior iterations output a longer image (unexpected!)
-      stream.seek(0)     # rewind to start reading
-      data = stream.read()
-      img = imaging.Image(data)
-      yield (img, data)
-      stream.seek(0)  # if we don't rewind again capture_continuous() will write at the end
+    if not self._c:
+      raise Exception('Not initialized')
+    lib.SleepUntil(self._ready_at)
+    img = imaging.Image.FromRaw(self._mv, self._shape, padded_shape=self._padded_shape)
+    logging.info('Camera taking continuous raw rgb images from video port')
+    for _ in self._c.capture_continuous(self._mv, format='rgb', use_video_port=True):
+      yield (img, self._mv)
+
+  def StreamTo(self,
+               on_frame: Callable[[int, imaging.Image], Any],
+               stop_flag: Any) -> int:
+    """Stream raw RGB images to a callback, in this process, until `stop_flag` is set. Will block.
+
+    Frames are delivered by picamera's own callback mechanism into a small bounded buffer, so
+    there is no subprocess and no queue: `on_frame` always gets the freshest frame and, if it is
+    slower than the camera, the frames in between are dropped. Each image is a new object that
+    the callback is free to keep.
+
+    Args:
+      on_frame: Called as on_frame(n, img) for each frame, where n is the frame counter and img
+          the Nth imaging.Image object; called in the thread that called StreamTo()
+      stop_flag: Any object with a `value` attribute (for example a multiprocessing.Value('b')),
+          that should start 0 (False) and become 1 (True) when streaming should end
+
+    Returns:
+      number of frames delivered to `on_frame`
+    """
+    if not self._c:
+      raise Exception('Not initialized')
+    lib.SleepUntil(self._ready_at)
+    output = _LatestFrames(self._c)
+    timeout = Cam._STREAM_TIMEOUT_FRAMES / self._framerate
+    n = 0
+    logging.info('Camera streaming raw rgb images from video port to callback')
+    self._c.start_recording(output, format='rgb')
+    try:
+      while not stop_flag.value:
+        self._c.wait_recording(0)  # re-raises any error from the camera thread
+        array = output.Latest(timeout)
+        if array is None:
+          continue
+        on_frame(n, imaging.Image(array))
+        n += 1
+    finally:
+      self._c.stop_recording()
+    logging.info('Camera streamed %d images (%d stale images dropped)', n, output.dropped)
+    return n
+
+
+_LOG_DROPPED_EVERY = 100  # images
 
 
 def QueueImages(queue: multiprocessing.JoinableQueue,
-                stop_flag: multiprocessing.sharedctypes.Synchronized) -> None:
+                stop_flag: multiprocessing.sharedctypes.Synchronized,
+                ring: Optional[imaging.SharedImageRing] = None,
+                cpu: Optional[int] = None) -> None:
   """Define a subprocess for streaming images continuously.
 
   Expects to be the entry point for a multiprocessing.Process() call. Will write to `queue`
-  continuously until `stop_flag` becomes !=0 (True).
+  continuously until `stop_flag` becomes !=0 (True). If `queue` is bounded (has a `maxsize`) and
+  full, the oldest images in it are discarded, so the consumer always gets the freshest ones.
+
+  Can also be the target of a threading.Thread() call, with a queue.Queue: picamera does all its
+  MMAL calls through ctypes and waits for frames on events, both of which release the GIL, so
+  capture will overlap with the other threads; this avoids pickling every image into a pipe.
+  If the consumer can live in the camera's process, Cam.StreamTo() avoids the queue altogether.
 
   Args:
-    queue: a multiprocessing.Queue object that will receive (n, img) tuples, where n is the
-        image counter and img is the Nth imaging.Image object
-    stop_flag: a multiprocessing.Value('b', 0, lock=True) byte ('b' signed char) object that
-        should start 0 (False) and become 1 (True) when the process should end.
+    queue: a multiprocessing.Queue (or queue.Queue) object that will receive (n, img) tuples,
+        where n is the image counter and img is the Nth imaging.Image object
+    stop_flag: a multiprocessing.Value('b', 0, lock=False) byte ('b' signed char) object that
+        should start 0 (False) and become 1 (True) when the process should end; for a thread
+        any object with a `value` attribute will do
+    ring: (default None) If given, images are written to this ring and `queue` receives
+        (n, ticket) tuples instead, where ticket is the one returned by SharedImageRing.Put();
+        this avoids pickling every image through the queue
+    cpu: (default None) If given, tries to pin the process to this CPU core (see
+        lib.SetCpuAffinity()); do not use it from a thread, as it would pin the whole process
   """
   logging.info('Starting image capture pipeline')
+  if cpu is not None:
+    lib.SetCpuAffinity(cpu)
+  dropped, debug = 0, logging.getLogger().isEnabledFor(logging.DEBUG)
   with Cam() as cam:
     for n, (img, _) in enumerate(cam.Stream()):
       if stop_flag.value:
         break
-      logging.debug('Capture image #%04d', n)
-      queue.put((n, img))
-  logging.info('Image capture pipeline stopped')
+      if debug:
+        logging.debug('Capture image #%04d', n)
+      # the queue pickles later (or a thread holds it), so never hand it the reused buffer
+      item = img.Copy() if ring is None else ring.Put(img)
+      dropped += lib.PutDiscardingOldest(queue, (n, item))
+      if dropped and not n % _LOG_DROPPED_EVERY:
+        logging.info('Dropped %d stale images so far (of %d)', dropped, n)
+  logging.info('Image capture pipeline stopped (%d stale images dropped)', dropped)
@@ -6,8 +6,10 @@ import logging          # noqa: E402
 import multiprocessing  # noqa: E402
 import multiprocessing.sharedctypes  # noqa: E402
 # import pdb                           # noqa: E402
-import time  # noqa: E402
-from typing import Callable, Tuple  # noqa: E402
+import signal          # noqa: E402
+import threading        # noqa: E402
+import time             # noqa: E402
+from typing import Callable, Optional, Tuple  # noqa: E402
 
 from Code.Server import balparda_imaging as imaging  # noqa: E402
 from Code.Server import balparda_lib as lib          # noqa: E402
@@ -18,6 +20,10 @@ else:
 
 
 _MAX_RUNTIME = 180.0            # seconds
+_IMAGE_QUEUE_SIZE = 1           # images; older images are discarded when full
+_BRIGHTNESS_QUEUE_SIZE = 1      # brightness foci; ditto
+_MOTOR_QUEUE_SIZE = 1           # motor commands; ditto
+_IMAGE_SHAPE = (600, 800, 3)    # (height, width, RGB) of the car.Cam default (and mock) images
 _ANGLE_OF_VIEW = (53.5, 41.41)  # degrees
 _NECK_OFFSET = (6, -30)         # degrees
 _MIN_SONAR_DISTANCE = 0.20      # meters
@@ -25,6 +31,13 @@ _V_ANGLE = 45                   # degrees
 _ANGLE_TARGET_PRECISION = 5     # degrees
 _CAR_SPEED = 1
 _CAR_MOVE_INCREMENT_TIME = 0.5  # seconds
+_DECISION_PERIOD = 0.05         # seconds (20Hz); slower decisions drop frames, never queue them
+_DECISION_PRIORITY = 10         # SCHED_FIFO priority, only works on Linux and with privileges
+_SONAR_PERIOD = 0.1             # seconds (10Hz)
+_SONAR_STALE_TIME = 0.5         # seconds without a new sonar reading to consider the sonar lost
+# CPU cores to pin each process to (on the real car only: the Raspberry Pi has 4 cores), so they
+# don't migrate between cores; sonar and motor processes mostly sleep, so they can share one
+_IMAGE_CPU, _BRIGHTNESS_CPU, _DECISION_CPU, _MOTOR_CPU = 0, 1, 2, 3
 _MOCK_TEMPLATE = 'Code/Server/testimg/capture-001-*.jpg'
 _SAVE_TEMPLATE = 'Code/Server/testimg/capture-002-%03d.jpg'
 
@@ -39,92 +52,243 @@ def _MainPipelines(max_runtime: float = 3600.0, mock: bool = False) -> None:
   max_runtime = float(max_runtime)
   if max_runtime < 1.0:
     raise Exception('max_runtime must be at least 1.0 (got %f)' % max_runtime)
-  # setup image pipeline (real or mock) with its queue and process semaphore
-  img_queue = multiprocessing.JoinableQueue()  # type: multiprocessing.JoinableQueue
+  # setup image pipeline (real or mock) with its queue, shared image ring and process semaphore
+  img_queue = multiprocessing.JoinableQueue(
+      maxsize=_IMAGE_QUEUE_SIZE)  # type: multiprocessing.JoinableQueue
+  img_ring = imaging.SharedImageRing(_IMAGE_SHAPE)
   img_stop: multiprocessing.sharedctypes.Synchronized
-  img_stop = multiprocessing.Value('b', 0, lock=True)  # type: ignore
+  img_stop = multiprocessing.Value('b', 0, lock=False)  # type: ignore
   img_process = multiprocessing.Process(
       target=imaging.MockQueueImages if mock else car.QueueImages,
       name='image-pipeline',
-      args=((img_queue, img_stop, _MOCK_TEMPLATE, .7) if mock else
-            (img_queue, img_stop)),
+      args=((img_queue, img_stop, _MOCK_TEMPLATE, .7, img_ring) if mock else
+            (img_queue, img_stop, img_ring, _IMAGE_CPU)),
       daemon=True)
+  # flag set while a move is pending or the car is moving (when images are just motion blur),
+  # and the time.monotonic() the last move ended, so older images (blurred, or taken from where
+  # the car no longer is) can be told apart; with a lock, as doubles may not be written at once
+  in_motion: multiprocessing.sharedctypes.Synchronized
+  in_motion = multiprocessing.Value('b', 0, lock=False)  # type: ignore
+  motion_ended: multiprocessing.sharedctypes.Synchronized
+  motion_ended = multiprocessing.Value('d', 0.0)  # type: ignore
   # setup processing pipeline (feeding real or mock images) with its queue and process semaphore
-  brightness_queue = multiprocessing.JoinableQueue()  # type: multiprocessing.JoinableQueue
+  brightness_queue = multiprocessing.JoinableQueue(
+      maxsize=_BRIGHTNESS_QUEUE_SIZE)  # type: multiprocessing.JoinableQueue
   brightness_stop: multiprocessing.sharedctypes.Synchronized
-  brightness_stop = multiprocessing.Value('b', 0, lock=True)  # type: ignore
+  brightness_stop = multiprocessing.Value('b', 0, lock=False)  # type: ignore
   brightness_process = multiprocessing.Process(
       target=lib.UpToDateProcessingPipeline,
       name='brightness-pipeline',
       args=(img_queue,         # feed from image queue
             brightness_queue,  # write to this new queue
-            lambda i: (i[0], i[1], i[1].BrightnessFocus()),  # processing is trivial in fact
+            _BrightnessFocusMaker(img_ring, in_motion, motion_ended),  # trivial processing
             brightness_stop,
-            'brightness-pipeline'),
+            'brightness-pipeline',
+            None,  # no period: process images as they come
+            None,  # no realtime priority
+            None if mock else _BRIGHTNESS_CPU),
+      daemon=True)
+  # setup sonar (real or mock) reading loop, which keeps the latest distance in a shared value,
+  # with a reading counter so a sonar that stopped (or never started) can be detected
+  sonar_dist: multiprocessing.sharedctypes.Synchronized
+  sonar_dist = multiprocessing.Value('f', 0.0, lock=False)  # type: ignore
+  sonar_seq: multiprocessing.sharedctypes.Synchronized
+  sonar_seq = multiprocessing.Value('I', 0, lock=False)  # type: ignore
+  sonar_stop: multiprocessing.sharedctypes.Synchronized
+  sonar_stop = multiprocessing.Value('b', 0, lock=False)  # type: ignore
+  sonar_process = multiprocessing.Process(
+      target=_SonarLoop,
+      name='sonar-loop',
+      args=(sonar_dist, sonar_seq, sonar_stop, mock, None if mock else _MOTOR_CPU),
       daemon=True)
   # setup decision and neck (real or mock) pipeline with its semaphore
-  motor_queue = multiprocessing.JoinableQueue()  # type: multiprocessing.JoinableQueue
+  motor_queue = multiprocessing.JoinableQueue(
+      maxsize=_MOTOR_QUEUE_SIZE)  # type: multiprocessing.JoinableQueue
   decision_stop: multiprocessing.sharedctypes.Synchronized
-  decision_stop = multiprocessing.Value('b', 0, lock=True)  # type: ignore
+  decision_stop = multiprocessing.Value('b', 0, lock=False)  # type: ignore
   decision_process = multiprocessing.Process(
       target=lib.UpToDateProcessingPipeline,
       name='decision-pipeline',
       args=(brightness_queue,  # feed from brightness queue
             None,              # end of pipeline, so don't feed a new queue
             _MovementDecisionMaker(motor_queue,  # atual movement decision operation
+                                   img_ring,
+                                   sonar_dist,
+                                   sonar_seq,
+                                   in_motion,
+                                   motion_ended,
                                    desired_v_angle=_V_ANGLE,
                                    mock=mock),
             decision_stop,
-            'decision-pipeline'),
+            'decision-pipeline',
+            _DECISION_PERIOD,
+            None if mock else _DECISION_PRIORITY,
+            None if mock else _DECISION_CPU),
       daemon=True)
   # setup motor wheel moving pipeline (acting on real or mock cars) with its semaphore
   motor_stop: multiprocessing.sharedctypes.Synchronized
-  motor_stop = multiprocessing.Value('b', 0, lock=True)  # type: ignore
+  motor_stop = multiprocessing.Value('b', 0, lock=False)  # type: ignore
   motor_process = multiprocessing.Process(
       target=lib.UpToDateProcessingPipeline,
       name='motor-pipeline',
       args=(motor_queue,  # feed from motor queue
             None,         # end of pipeline, so don't feed a new queue
-            _MotorActuatorMaker(mock=mock),  # atual motor operation
+            _MotorActuatorMaker(in_motion, motion_ended, mock=mock),  # atual motor operation
             motor_stop,
-            'motor-pipeline'),
+            'motor-pipeline',
+            None,  # no period: move as commands come
+            None,  # no realtime priority
+            None if mock else _MOTOR_CPU),
       daemon=True)
   # start
   ini_tm, runtime = time.time(), 0.0
   logging.info(
-      'Starting pipeline processes: camera, brightness, decision, neck & motor (@%0.2f)', ini_tm)
+      'Starting pipeline processes: camera, brightness, sonar, decision, neck & motor (@%0.2f)',
+      ini_tm)
+  sonar_process.start()
   decision_process.start()
   brightness_process.start()
   img_process.start()
   motor_process.start()
+  # a Ctrl-C just ends the wait below (after the processes started, so they don't inherit this)
+  end_event = threading.Event()
+  previous_sigint = None
+  if threading.current_thread() is threading.main_thread():  # signal.signal() needs main thread
+    previous_sigint = signal.signal(signal.SIGINT, lambda *_: end_event.set())
   try:
-    # sleep while the pipeline does the job, or while we wait for a Ctrl-C, or while we count time
-    while runtime < max_runtime:
-      time.sleep(0.3)  # main thread should mostly block here
-      runtime = time.time() - ini_tm
+    # block while the pipeline does the job, until max_runtime or a Ctrl-C, whichever is first
+    end_event.wait(timeout=max_runtime)
+    runtime = time.time() - ini_tm
   finally:
+    if previous_sigint is not None:
+      signal.signal(signal.SIGINT, previous_sigint)
     # signal stop and wait for queues
     logging.info('End signal (@%0.2f seconds runtime). Waiting for image pipeline', runtime)
     img_stop.value = 1
     brightness_stop.value = 1
+    sonar_stop.value = 1
     decision_stop.value = 1
     motor_stop.value = 1
     img_process.join()
     logging.info('Waiting for processing pipeline')
     brightness_process.join()
+    logging.info('Waiting for sonar loop')
+    sonar_process.join()
     logging.info('Waiting for decision pipeline')
     decision_process.join()
     logging.info('Waiting for motor pipeline')
     motor_process.join()
+    img_ring.Close()
+
+
+def _BrightnessFocusMaker(img_ring: imaging.SharedImageRing,
+                          in_motion: multiprocessing.sharedctypes.Synchronized,
+                          motion_ended: multiprocessing.sharedctypes.Synchronized) -> Callable:
+  """Create a brightness focus processor that reads the images from `img_ring`.
+
+  Args:
+    img_ring: the imaging.SharedImageRing the image pipeline writes to
+    in_motion: the multiprocessing.Value('b') that is 1 while the car is moving; images that
+        arrive meanwhile are dropped without any processing
+    motion_ended: the multiprocessing.Value('d') with the time.monotonic() the last move ended;
+        images captured before it (SharedImageRing.CaptureTime()) are dropped too, as they were
+        taken while (or before) the car moved, even if they only get here after it stopped
+  """
+
+  def _BrightnessFocus(
+      input: Tuple[int, Tuple[int, int]]
+  ) -> Optional[Tuple[int, Tuple[int, int], float, Tuple[int, int]]]:
+    """Get the brightness focus for an image (if it was not overwritten in the ring yet).
+
+    Returns:
+      (num_img, ticket, captured, focus): the image stays in the ring, so only its ticket is
+      passed on, with its capture time, so later stages don't need the slot to still be there
+    """
+    num_img, ticket = input
+    if in_motion.value:
+      logging.debug('Image #%04d dropped: car in motion', num_img)
+      return None
+    captured = img_ring.CaptureTime(ticket)
+    img = img_ring.Peek(ticket)  # no copy: BrightnessFocus() only reads a subsample anyway
+    if captured is None or img is None:
+      logging.debug('Image #%04d was overwritten before processing', num_img)
+      return None
+    if captured < motion_ended.value:
+      logging.debug('Image #%04d dropped: captured before the car stopped', num_img)
+      return None
+    focus = img.BrightnessFocus()
+    if not img_ring.Valid(ticket):
+      logging.debug('Image #%04d was overwritten while processing', num_img)
+      return None
+    return (num_img, ticket, captured, focus)
+
+  return _BrightnessFocus
+
+
+def _SonarLoop(sonar_dist: multiprocessing.sharedctypes.Synchronized,
+               sonar_seq: multiprocessing.sharedctypes.Synchronized,
+               stop_flag: multiprocessing.sharedctypes.Synchronized,
+               mock: bool = False,
+               cpu: Optional[int] = None) -> None:
+  """Define a subprocess that keeps reading the (real or mock) sonar, at _SONAR_PERIOD.
+
+  Sonar readings take tens of ms, so doing them here keeps them out of the decision pipeline,
+  that just reads the latest value from `sonar_dist`.
+
+  Args:
+    sonar_dist: a multiprocessing.Value('f', 0.0, lock=False) that will always have the latest
+        distance reading, in meters
+    sonar_seq: a multiprocessing.Value('I', 0, lock=False) that is incremented after each new
+        reading is in `sonar_dist` (so 0 means there was no reading yet)
+    stop_flag: a multiprocessing.Value('b', 0, lock=False) byte ('b' signed char) object that
+        should start 0 (False) and become 1 (True) when the process should end
+    mock: (default False) if True will use a mock sonar that doesn't require hardware to run
+    cpu: (default None) If given, tries to pin the process to this CPU core (see
+        lib.SetCpuAffinity())
+  """
+
+  class _MockSonar():  # mock car.Sonar
+
+    def Read(self) -> float:
+      time.sleep(0.1)
+      return 1.0
+
+  sonar: _MockSonar
+  sonar = _MockSonar() if mock else car.Sonar()  # type: ignore
+  logging.info('Sonar loop starting')
+  if cpu is not None:
+    lib.SetCpuAffinity(cpu)
+  slot = time.monotonic()
+  while not stop_flag.value:
+    sonar_dist.value = sonar.Read()
+    sonar_seq.value += 1  # a c_uint, so it just wraps around
+    slot = lib.NextPeriodSlot(slot, _SONAR_PERIOD)
+    lib.SleepUntil(slot)
+  logging.info('Sonar loop ending')
 
 
 def _MovementDecisionMaker(motor_queue: multiprocessing.JoinableQueue,
+                           img_ring: imaging.SharedImageRing,
+                           sonar_dist: multiprocessing.sharedctypes.Synchronized,
+                           sonar_seq: multiprocessing.sharedctypes.Synchronized,
+                           in_motion: multiprocessing.sharedctypes.Synchronized,
+                           motion_ended: multiprocessing.sharedctypes.Synchronized,
                            desired_v_angle: int = 45,
                            mock: bool = False) -> Callable:
   """Create a decision maker incorporating either the real or a mock car.
 
   Args:
     motor_queue: a multiprocessing.Queue object to write to
+    img_ring: the imaging.SharedImageRing the images are in (of shape _IMAGE_SHAPE)
+    sonar_dist: the multiprocessing.Value('f') the _SonarLoop() keeps the distance in
+    sonar_seq: the multiprocessing.Value('I') the _SonarLoop() counts its readings in; if it
+        does not change for _SONAR_STALE_TIME (or is still 0) the sonar is considered lost and
+        the car will not drive ahead or back, as the way might not be clear
+    in_motion: the multiprocessing.Value('b') that is 1 while the car is moving; it is also set
+        here when a move is dispatched, so it covers the move still waiting in `motor_queue`
+    motion_ended: the multiprocessing.Value('d') with the time.monotonic() the last move ended;
+        foci from images captured while (or before) the car moved are ignored, as they would
+        just repeat the move that was already made
     desired_v_angle: (default 45) vertical angle the car will try to keep constant
     mock: (default False) if True will use mock car classes that don't require hardware to run
   """
@@ -138,73 +302,90 @@ def _MovementDecisionMaker(motor_queue: multiprocessing.JoinableQueue,
       self._pos = (0, 0)
       logging.info('Neck to ZERO/CENTER')
 
-    def Delta(self, h: int, v: int) -> None:
-      h, v = self._pos[0] + h, self._pos[1] + v
-      if h < -70: h = -70  # noqa: E701
-      if h > 70:  h = 70   # noqa: E701
-      if v < -20: v = -20  # noqa: E701
-      if v > 70:  v = 70   # noqa: E701
+    def Set(self, h: int, v: int, slew: bool = True) -> float:
+      h, v = max(-70, min(70, h)), max(-20, min(70, v))  # same limits as car.Neck
       self._pos = (h, v)
       logging.info('Neck to position (H: %+02d, V: %+02d) degrees', h, v)
-      time.sleep(0.5)
+      if slew:
+        time.sleep(0.5)
+        return time.monotonic()
+      return time.monotonic() + 0.5
 
     def Read(self) -> Tuple[int, int]:
       return self._pos
 
-  class _MockSonar():  # mock car.Sonar
-
-    def Read(self) -> float:
-      time.sleep(0.1)
-      return 1.0
-
-  sonar: _MockSonar
   neck: _MockNeck
-  sonar = _MockSonar() if mock else car.Sonar()                  # type: ignore
   neck = _MockNeck() if mock else car.Neck(offset=_NECK_OFFSET)  # type: ignore
   neck.Zero()
-
-  def _MovementDecision(input: Tuple[int, imaging.Image, Tuple[int, int]]) -> None:
-    """Take a "step" movement decision based on a camera and sonar reading."""
-    # TODO: maybe move sonar readings into a separate pipeline? Is it even needed? Test sonar speed.
-    num_img, img, (x_focus, y_focus) = input
-    # img.Save(_SAVE_TEMPLATE % num_img)  # uncomment to save the stream for testing...
+  # constant for every decision: compute once here, not per call
+  point_to_angle = imaging.PointToAngleMaker(
+      (_IMAGE_SHAPE[1], _IMAGE_SHAPE[0]), *_ANGLE_OF_VIEW)  # (width, height), (x_aov, y_aov)
+  precision = _ANGLE_TARGET_PRECISION
+  last_sonar_seq, last_sonar_time = 0, time.monotonic()  # last reading seen, and when
+  neck_settled = 0.0  # time.monotonic() the last neck move should be done at
+
+  def _MovementDecision(input: Tuple[int, Tuple[int, int], float, Tuple[int, int]]) -> None:
+    """Take a "step" movement decision based on a camera and sonar reading.
+
+    As the neck is moved without blocking, foci from images captured before it settled are
+    ignored: they were taken from another point of view.
+    """
+    nonlocal last_sonar_seq, last_sonar_time, neck_settled
+    num_img, ticket, captured, (x_focus, y_focus) = input
+    if in_motion.value or captured < motion_ended.value:
+      logging.debug('Foci for image #%04d ignored: car was moving', num_img)
+      return
+    if captured < neck_settled:
+      logging.debug('Foci for image #%04d ignored: neck was moving', num_img)
+      return
+    # img_ring.Get(ticket).Save(_SAVE_TEMPLATE % num_img)  # uncomment to save the stream...
     # convert the point we got into angles as seen by the camera so we can plan to move the neck
-    x_angle, y_angle = img.PointToAngle(x_focus, y_focus, _ANGLE_OF_VIEW[0], _ANGLE_OF_VIEW[1])
+    x_angle, y_angle = point_to_angle(x_focus, y_focus)
     x_angle, y_angle = lib.MinAngle(int(round(x_angle))), lib.MinAngle(int(round(y_angle)))
-    dist = sonar.Read()
+    dist, sonar_seq_now, now = sonar_dist.value, sonar_seq.value, time.monotonic()
+    if sonar_seq_now != last_sonar_seq:
+      last_sonar_seq, last_sonar_time = sonar_seq_now, now
+    sonar_ok = sonar_seq_now and now - last_sonar_time < _SONAR_STALE_TIME
     logging.info('Got foci for image #%04d: (%d, %d) @ %0.2fm', num_img, x_angle, y_angle, dist)
-    if abs(x_angle) < _ANGLE_TARGET_PRECISION: x_angle = 0  # noqa: E701
-    if abs(y_angle) < _ANGLE_TARGET_PRECISION: y_angle = 0  # noqa: E701
+    if abs(x_angle) < precision: x_angle = 0  # noqa: E701
+    if abs(y_angle) < precision: y_angle = 0  # noqa: E701
     h, v = neck.Read()
     h, v = h + x_angle, v + y_angle  # (h, v) is the predicted neck position after the neck move
     # we now make the body (motor) moving decisions
     move, move_angle, move_speed = False, 0, 0.0
-    if abs(h) >= _ANGLE_TARGET_PRECISION:  # need to turn?
+    if abs(h) >= precision:  # need to turn?
       move, move_angle = True, h
-    if dist < _MIN_SONAR_DISTANCE:  # if we are too close to an obstacle we go back
+    if not sonar_ok:  # no (recent) reading from _SonarLoop(): we might be driving blind
+      logging.warning('No recent sonar reading: car will not move ahead or back')
+    elif dist < _MIN_SONAR_DISTANCE:  # if we are too close to an obstacle we go back
       logging.info('Obstacle detected')
       move, move_speed = True, -_CAR_SPEED
     else:
-      if abs(desired_v_angle - v) >= _ANGLE_TARGET_PRECISION:  # need to move?
+      if abs(desired_v_angle - v) >= precision:  # need to move?
         move, move_speed = True, _CAR_SPEED * (1 if desired_v_angle > v else -1)
     # if we are going to move the car, then dispatch that to the body moving pipeline
     if move:
-      motor_queue.put((move_angle, move_speed))
+      in_motion.value = 1  # now, not when the motor pipeline gets to it, so no focus sneaks in
+      lib.PutDiscardingOldest(motor_queue, (move_angle, move_speed))
     else:
       logging.info('Car is on target')
-    # now that we dispatched that order, we move the neck in parallel
+    # now that we dispatched that order, we move the neck in parallel, without waiting for it
     if x_angle or y_angle:
-      neck.Delta(x_angle, y_angle)
+      neck_settled = neck.Set(h, v, slew=False)
     else:
       logging.info('Neck is on target')
 
   return _MovementDecision
 
 
-def _MotorActuatorMaker(mock: bool = False) -> Callable:
+def _MotorActuatorMaker(in_motion: multiprocessing.sharedctypes.Synchronized,
+                        motion_ended: multiprocessing.sharedctypes.Synchronized,
+                        mock: bool = False) -> Callable:
   """Create a motor actuator incorporating either the real or a mock car.
 
   Args:
+    in_motion: a multiprocessing.Value('b') to set to 1 while the car is moving (0 otherwise)
+    motion_ended: a multiprocessing.Value('d') to set to the time.monotonic() each move ends
     mock: (default False) if True will use mock car classes that don't require hardware to run
   """
 
@@ -224,10 +405,15 @@ def _MotorActuatorMaker(mock: bool = False) -> Callable:
   def _MotorActuator(input: Tuple[int, float]) -> None:
     """Execute a "step" motor action."""
     move_angle, move_speed = input
-    if move_angle:
-      engine.Turn(move_angle)
-    if abs(move_speed) > 0.01:
-      engine.Straight(move_speed, _CAR_MOVE_INCREMENT_TIME)
+    in_motion.value = 1
+    try:
+      if move_angle:
+        engine.Turn(move_angle)
+      if abs(move_speed) > 0.01:
+        engine.Straight(move_speed, _CAR_MOVE_INCREMENT_TIME)
+    finally:
+      motion_ended.value = time.monotonic()  # before clearing in_motion, so there is no gap
+      in_motion.value = 0
 
   return _MotorActuator
 
@@ -1,15 +1,17 @@
 """Imaging module."""
 
+import concurrent.futures
 import glob
 import io
 import itertools
 import logging
 import math
 import multiprocessing
+import multiprocessing.shared_memory
 import multiprocessing.sharedctypes
 # import pdb
 import time
-from typing import List, Tuple, Union
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np         # type: ignore
 from scipy import ndimage  # type: ignore
@@ -17,6 +19,8 @@ from matplotlib import pyplot as plt  # type: ignore
 from matplotlib import patches
 import imageio  # type: ignore
 
+from Code.Server import balparda_lib as lib
+
 # https://scipy-lectures.org/advanced/image_processing/
 # https://docs.scipy.org/doc/
 # https://docs.scipy.org/doc/scipy/reference/ndimage.html
@@ -37,21 +41,160 @@ def CameraAngleOfView(focal_length: float, sensor_size: float) -> float:
   return math.degrees(2.0 * math.atan(sensor_size / (2.0 * focal_length)))
 
 
+def PointToAngle(x: int,
+                 y: int,
+                 dimensions: Tuple[int, int],
+                 x_angle_view: float,
+                 y_angle_view: float) -> Tuple[float, float]:
+  """Convert image point (x,y) to an angle in the real world based on x/y angle of view.
+
+  Same as Image.PointToAngle(), for when only the image dimensions are at hand. This is linear
+  (no trigonometry), so `x` and `y` can also be np.ndarray of many points, converted at once.
+
+  Args:
+    x: x dimension (int, or np.ndarray)
+    y: y dimension (int, or np.ndarray)
+    dimensions: image (width, height), in pixels
+    x_angle_view: horizontal angle of view (degrees)
+    y_angle_view: vertical angle of view (degrees)
+
+  Returns:
+    (x_angle, y_angle) the real world angle corresponding to point (x,y) where (0, 0) is the
+    center of the image
+  """
+  x_dim, y_dim = dimensions
+  x_degrees_per_px = x_angle_view / float(x_dim)
+  y_degrees_per_px = y_angle_view / float(y_dim)
+  return ((x - x_dim / 2) * x_degrees_per_px, (y_dim / 2 - y) * y_degrees_per_px)
+
+
+def PointToAngleMaker(dimensions: Tuple[int, int],
+                      x_angle_view: float,
+                      y_angle_view: float) -> Callable[[Any, Any], Tuple[Any, Any]]:
+  """Create a PointToAngle() call specialized for fixed image dimensions and angles of view.
+
+  For loops where the camera (and so all of these) never changes: the scales and the center are
+  computed once here, so each call is just two multiply-adds, with no divisions.
+
+  Args:
+    dimensions: image (width, height), in pixels
+    x_angle_view: horizontal angle of view (degrees)
+    y_angle_view: vertical angle of view (degrees)
+
+  Returns:
+    a call like point_to_angle(x, y) -> (x_angle, y_angle), same result as PointToAngle()
+  """
+  x_dim, y_dim = dimensions
+  x_degrees_per_px = x_angle_view / float(x_dim)
+  y_degrees_per_px = y_angle_view / float(y_dim)
+  x_offset = -x_dim / 2 * x_degrees_per_px  # x_angle = x * x_degrees_per_px + x_offset
+  y_offset = y_dim / 2 * y_degrees_per_px   # y_angle = y_offset - y * y_degrees_per_px
+
+  def _PointToAngle(x: Any, y: Any) -> Tuple[Any, Any]:
+    return (x * x_degrees_per_px + x_offset, y_offset - y * y_degrees_per_px)
+
+  return _PointToAngle
+
+
+class _BufferReader(io.RawIOBase):
+  """Read-only, seekable file object over any buffer protocol object, WITHOUT copying it.
+
+  The decoder reads straight from the buffer (into its own read buffers, a chunk at a time), so
+  unlike bytes(buf), or imageio's own handling of memoryview, there is no full copy of it first.
+  """
+
+  def __init__(self, buf: Any) -> None:
+    """Wrap `buf`, like a bytearray or memoryview, as its flat bytes."""
+    super().__init__()
+    self._data = np.frombuffer(buf, dtype=np.uint8)
+    self._pos = 0
+
+  def readable(self) -> bool:
+    """Always readable."""
+    return True
+
+  def seekable(self) -> bool:
+    """Always seekable."""
+    return True
+
+  def tell(self) -> int:
+    """Current position."""
+    return self._pos
+
+  def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+    """Move to `offset` from the start, current position, or end (`whence`), like io.IOBase."""
+    if whence not in (io.SEEK_SET, io.SEEK_CUR, io.SEEK_END):
+      raise ValueError('Invalid whence %r' % whence)
+    start = (0, self._pos, self._data.size)[whence]
+    self._pos = max(0, start + offset)
+    return self._pos
+
+  def readinto(self, out: Any) -> int:
+    """Copy the next bytes into the `out` buffer, as many as fit."""
+    chunk = self._data[self._pos:self._pos + len(out)]
+    np.frombuffer(out, dtype=np.uint8, count=chunk.size)[:] = chunk
+    self._pos += chunk.size
+    return chunk.size
+
+
 class Image():
   """General imaging class."""
 
-  def __init__(self, img: Union[np.ndarray, str, io.BytesIO]) -> None:
-    """Load an `img` as a copy of another object, as a path, URL, or io.BytesIO.
+  __slots__ = ('_img', '_rgb')  # also makes pickling (through queues) just the array & flag
+
+  def __init__(
+      self, img: Union[np.ndarray, str, bytes, bytearray, memoryview, io.BytesIO]) -> None:
+    """Load an `img` as a copy of another object, as a path, URL, encoded bytes, or io.BytesIO.
 
     Args:
-      img: another object, as a path, URL, or io.BytesIO.
+      img: another object, as a path, URL, or io.BytesIO; also bytes, bytearray or memoryview
+          (like io.BytesIO.getbuffer()) holding an encoded image, which is decoded straight from
+          the buffer, without a copy of it first; for raw pixels use FromRaw();
+          pixels that are not np.uint8 are converted once, here, with astype() (so values must
+          already be in the 0-255 range), and strided pixels (like a img[::2, ::2] view) are
+          copied into a compact C-contiguous array; np.uint8 C-contiguous pixels are not copied
     """
     if isinstance(img, np.ndarray):
-      self._img = img  # init with data
+      pixels = img  # init with data
     else:
-      self._img = imageio.imread(img)  # takes file paths, URLs, and io.BytesIO
+      if isinstance(img, (bytearray, memoryview)):
+        img = _BufferReader(img)  # not all imageio versions take these, and bytes() copies
+      pixels = imageio.imread(img)  # takes file paths, URLs, bytes, and file objects
+    # a single conversion here, so none of the per-frame methods hit strided or other-type data
+    pixels = pixels.astype(np.uint8, copy=False)  # no-op for the usual np.uint8
+    self._img = np.ascontiguousarray(pixels)      # no-op if not strided (or already converted)
     self._rgb = len(self._img.shape) == 3
 
+  @classmethod
+  def FromRaw(cls,
+              buf: Any,
+              shape: Tuple[int, ...],
+              padded_shape: Optional[Tuple[int, ...]] = None) -> 'Image':
+    """Wrap raw np.uint8 pixels in `buf` as an image WITHOUT copying them (and without decoding).
+
+    ATTENTION: the image aliases `buf` and will change if `buf` changes; call Copy() to keep it.
+
+    Args:
+      buf: any buffer protocol object, like a bytearray, a memoryview, or SharedMemory.buf
+      shape: image shape, like (height, width, 3) for RGB or (height, width) for greyscale
+      padded_shape: (default None) If given, is the shape of the data in `buf` when its rows
+          and/or columns were padded (as picamera does for raw captures); the image will then be
+          the top-left `shape` part of it
+
+    Returns:
+      imaging.Image object
+    """
+    full_shape = padded_shape if padded_shape else shape
+    pixels = np.frombuffer(buf, dtype=np.uint8, count=int(np.prod(full_shape))).reshape(full_shape)
+    obj = cls.__new__(cls)
+    obj._img = pixels[:shape[0], :shape[1]] if padded_shape else pixels
+    obj._rgb = len(shape) == 3
+    return obj
+
+  def Copy(self) -> 'Image':
+    """Return a new image object that owns a copy of this image's pixels."""
+    return Image(self._img.copy())
+
   def Save(self, out: Union[str, io.BytesIO]) -> None:
     """Save image to `out`, which can be a path or an io.BytesIO."""
     imageio.imsave(out, self._img)
@@ -71,20 +214,51 @@ class Image():
     plt.show()
 
   # (R,G,B) multipliers for greyscale conversion
-  _GREYSCALE_FACTORS = (299, 587, 114)
+  _GREYSCALE_FACTORS = (77, 150, 29)  # (0.299, 0.587, 0.114) in 1/256ths
+  _GREYSCALE_SHIFT = 8                 # 2 ** 8 == 256 == sum(_GREYSCALE_FACTORS)
 
   def Grey(self) -> np.ndarray:
     """Return a greyscale image object."""
     # https://stackoverflow.com/questions/12201577/how-can-i-convert-an-rgb-image-into-grayscale-in-python
     if not self._rgb:
       return self._img
-    added_img = ((Image._GREYSCALE_FACTORS[0] * self._img[:, :, 0].astype(np.int)) +
-                 (Image._GREYSCALE_FACTORS[1] * self._img[:, :, 1].astype(np.int)) +
-                 (Image._GREYSCALE_FACTORS[2] * self._img[:, :, 2].astype(np.int)))
-    return np.round(added_img / float(sum(Image._GREYSCALE_FACTORS))).astype(np.uint8)
+    # weighted sum in integer math, accumulated in place into a single uint16 buffer (the factors
+    # add up to 256, so 255 * 256 + 128 fits), then rounded and normalized with a bit shift
+    factors = Image._GREYSCALE_FACTORS
+    added_img = np.multiply(self._img[:, :, 0], factors[0], dtype=np.uint16)
+    added_img += np.multiply(self._img[:, :, 1], factors[1], dtype=np.uint16)
+    added_img += np.multiply(self._img[:, :, 2], factors[2], dtype=np.uint16)
+    added_img += 1 << (Image._GREYSCALE_SHIFT - 1)
+    added_img >>= Image._GREYSCALE_SHIFT
+    return added_img.astype(np.uint8)
 
   _BRIGHT_AREAS_BLUR_INDEX = 15.0  # lower value = more bluring
 
+  _BLUR_BOX_PASSES = 4  # with 3 the blur is less gaussian and can join areas it keeps apart
+  _BLUR_GAUSSIAN_MAX_SIGMA = 10.0  # up to this the true gaussian is cheap enough, see _Blur()
+
+  @staticmethod
+  def _Blur(img: np.ndarray, sigma: float) -> np.ndarray:
+    """Gaussian blur of `sigma`, approximated with _BLUR_BOX_PASSES box blurs if `sigma` is big.
+
+    Box (uniform) filters are running sums, so they cost the same for any `sigma`, while a true
+    gaussian filter costs proportionally to `sigma` (and here `sigma` grows with image size).
+    For small (subsampled) images `sigma` is small too, so the gaussian is cheap; there the box
+    approximation would also be coarse (few pixels per box), so the true gaussian is used.
+
+    Returns:
+      blurred image, as np.float32
+    """
+    if sigma <= Image._BLUR_GAUSSIAN_MAX_SIGMA:
+      return ndimage.gaussian_filter(img.astype(np.float32), sigma=sigma)
+    n = Image._BLUR_BOX_PASSES
+    size = int(round(math.sqrt(12.0 * sigma * sigma / n + 1.0)))  # box with the same variance
+    size += 1 - size % 2  # odd, so the boxes stay centered
+    blur_img = img.astype(np.float32)
+    for _ in range(n):
+      blur_img = ndimage.uniform_filter(blur_img, size=size)
+    return blur_img
+
   def _BrightAreas(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[int], int]:
     """Compute image bright areas.
 
@@ -93,12 +267,17 @@ class Image():
     """
     grey_img = self.Grey() if self._rgb else self._img
     blur_sigma = round(max(self._img.shape) / Image._BRIGHT_AREAS_BLUR_INDEX)
-    blur_img = ndimage.gaussian_filter(grey_img, sigma=blur_sigma)
+    blur_img = Image._Blur(grey_img, blur_sigma)
     bright_areas_mask = blur_img > blur_img.mean()
     bright_labels, nlabels = ndimage.label(bright_areas_mask)
     return (grey_img, blur_img, bright_areas_mask, bright_labels, nlabels)
 
-  def BrightnessFocus(self, use_masses: bool = True, plot: bool = False) -> Tuple[int, int]:
+  _BRIGHTNESS_FOCUS_SIZE = 100  # pixels, see BrightnessFocus()
+
+  def BrightnessFocus(self,
+                      use_masses: bool = True,
+                      plot: bool = False,
+                      max_size: Optional[int] = _BRIGHTNESS_FOCUS_SIZE) -> Tuple[int, int]:
     """Get the center of brightness for the image.
 
     Args:
@@ -106,16 +285,31 @@ class Image():
           brightest image areas; If False, counts each pixel in a bright area with the same
           weight regardless of its actual value.
       plot: (default False) If True will generate a plot for visualization.
+      max_size: (default 100) If given, the image is first subsampled (only the subsample is
+          copied, into a compact array) so its largest dimension is about `max_size` pixels; the
+          blur is relative to the image size, so the focus is that of the full resolution image
+          give or take about one subsampled pixel (for the 800x600 test images and the default
+          100, it is 8x subsampled and stays within 7.2 pixels), at a small fraction of the cost
+          (~30x faster); None means full resolution
 
     Returns:
-      (X,Y) values of the center of brightnes area mass
+      (X,Y) values of the center of brightnes area mass (always in this image's coordinates)
     """
+    step = (max(self._img.shape[:2]) // max_size) if max_size else 1
+    if step > 1:
+      x, y = Image(self._img[::step, ::step]).BrightnessFocus(
+          use_masses=use_masses, plot=plot, max_size=None)
+      return (x * step, y * step)
     grey_img, blur_img, bright_areas_mask, bright_labels, nlabels = self._BrightAreas()
     weight_img = blur_img if use_masses else bright_areas_mask
-    label_weights = ndimage.sum(weight_img, labels=bright_labels, index=range(nlabels + 1))
+    # one pass for the weight of all labels, then the center of mass only over the heaviest one
+    label_weights = np.bincount(
+        bright_labels.ravel(), weights=weight_img.ravel(), minlength=nlabels + 1)
     label_weights[0] = 0  # label 0 does not count here
-    com = ndimage.center_of_mass(weight_img, labels=bright_labels, index=np.argmax(label_weights))
-    com = (com[1], com[0])  # remember to invert axes
+    ys, xs = np.nonzero(bright_labels == np.argmax(label_weights))
+    weights = weight_img[ys, xs].astype(np.float64)
+    total = weights.sum()
+    com = (float(xs @ weights) / total, float(ys @ weights) / total)  # (x, y)
     if plot:
       fig, ax = plt.subplots(2)
       ax[0].imshow(self._img)
@@ -143,38 +337,169 @@ class Image():
       center of the image
     """
     y_dim, x_dim = self._img.shape[:2]
-    x_px_per_degrees = x_dim / float(x_angle_view)
-    y_px_per_degrees = y_dim / float(y_angle_view)
-    x -= x_dim / 2
-    y -= y_dim / 2
-    return (x / x_px_per_degrees, -y / y_px_per_degrees)
+    return PointToAngle(x, y, (x_dim, y_dim), x_angle_view, y_angle_view)
+
+
+class SharedImageRing():
+  """Ring of shared memory image slots, for passing images between processes without pickling.
+
+  Create it in the main process, before starting the processes, and pass it to both the producer
+  and the (single) consumer. The producer calls Put() and sends only the returned small "ticket"
+  through a queue; the consumer calls Get() with the ticket to get the image back (or Peek() and
+  Valid(), to use it in place). Slots are reused in a cycle, so each slot has a sequence counter
+  (odd while being written) that lets Get() detect images that were overwritten before (or
+  while) it could read them. Each slot also keeps the time its image was Put() (the capture
+  time, as the producer puts images right as they arrive), see CaptureTime().
+  """
+
+  _DEFAULT_SLOTS = 4
+
+  def __init__(self, shape: Tuple[int, ...], n_slots: int = _DEFAULT_SLOTS) -> None:
+    """Create the shared memory slots.
+
+    Args:
+      shape: shape of the (np.uint8) images that will go through the ring, like (600, 800, 3)
+      n_slots: (default 4) number of slots in the ring
+    """
+    if n_slots < 2:
+      raise Exception('SharedImageRing needs at least 2 slots (got %d)' % n_slots)
+    self._shape = tuple(shape)
+    self._shm = [multiprocessing.shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+                 for _ in range(n_slots)]
+    # no locks: 32 bit counters are written in one go even on 32 bit CPUs (a 'Q' might not be),
+    # and the (64 bit) times are only written while the slot's counter is odd, and only trusted
+    # if it was the same (even) before and after they were read, so a torn time is never used
+    self._seq = multiprocessing.sharedctypes.RawArray('I', n_slots)  # wraps, and stays even
+    self._times = multiprocessing.sharedctypes.RawArray('d', n_slots)  # time.monotonic()
+    self._next = 0  # only meaningful in the (single) producer process
+
+  def _Pixels(self, slot: int) -> np.ndarray:
+    return np.ndarray(self._shape, dtype=np.uint8, buffer=self._shm[slot].buf)
+
+  def Put(self, img: Image) -> Tuple[int, int]:
+    """Copy `img` into the next ring slot. Only one process should ever call Put().
+
+    Returns:
+      (slot, sequence) ticket that should be given to Get() to retrieve the image
+    """
+    if img._img.shape != self._shape:
+      raise Exception('Image shape %r does not fit ring of %r' % (img._img.shape, self._shape))
+    slot = self._next
+    self._next = (slot + 1) % len(self._shm)
+    self._seq[slot] += 1  # odd: slot is being written
+    self._times[slot] = time.monotonic()
+    self._Pixels(slot)[:] = img._img
+    self._seq[slot] += 1  # even: slot is ready
+    return (slot, self._seq[slot])
+
+  def Get(self, ticket: Tuple[int, int]) -> Optional[Image]:
+    """Get a copy of the image for `ticket` (as returned by Put()) out of the ring.
+
+    Returns:
+      imaging.Image object or None if the slot has already been overwritten by a newer image
+    """
+    slot, seq = ticket
+    if self._seq[slot] != seq:
+      return None
+    pixels = self._Pixels(slot).copy()
+    if self._seq[slot] != seq:
+      return None  # overwritten while copying
+    return Image(pixels)
+
+  def Peek(self, ticket: Tuple[int, int]) -> Optional[Image]:
+    """Get the image for `ticket` (as returned by Put()) as a view into the ring, WITHOUT copying.
+
+    ATTENTION: the producer may overwrite the slot at any moment, so use the image right away and
+    call Valid() with the same ticket after: only results computed from a view that was still
+    valid afterwards can be trusted; Get() is the safe (copying) alternative.
+
+    Returns:
+      imaging.Image object or None if the slot has already been overwritten by a newer image
+    """
+    slot, seq = ticket
+    if self._seq[slot] != seq:
+      return None
+    return Image(self._Pixels(slot))
+
+  def CaptureTime(self, ticket: Tuple[int, int]) -> Optional[float]:
+    """Get the time.monotonic() at which the image for `ticket` (as returned by Put()) was Put().
+
+    Returns:
+      time.monotonic() float or None if the slot has already been overwritten by a newer image
+    """
+    slot, seq = ticket
+    if self._seq[slot] != seq:
+      return None
+    tm = self._times[slot]
+    if self._seq[slot] != seq:
+      return None  # overwritten while reading
+    return tm
+
+  def Valid(self, ticket: Tuple[int, int]) -> bool:
+    """True if the image for `ticket` (as returned by Put()) is still in the ring, unchanged."""
+    slot, seq = ticket
+    return self._seq[slot] == seq
+
+  def Close(self) -> None:
+    """Free the shared memory. Call only once, from the process that created the ring."""
+    for shm in self._shm:
+      shm.close()
+      shm.unlink()
+
+
+def _DecodeAhead(paths: Iterator[str]) -> Iterator[Image]:
+  """Yield the decoded images for `paths`, decoding each one in a worker ahead of being needed."""
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+    decoding = None
+    for path in paths:
+      upcoming = pool.submit(Image, path)
+      if decoding is not None:
+        yield decoding.result()
+      decoding = upcoming
+    if decoding is not None:
+      yield decoding.result()
 
 
 def MockQueueImages(queue: multiprocessing.JoinableQueue,
                     stop_flag: multiprocessing.sharedctypes.Synchronized,
                     mock_images_glob: str,
-                    sleep_time: float) -> None:
+                    sleep_time: float,
+                    ring: Optional[SharedImageRing] = None,
+                    preload: bool = True) -> None:
   """Define a subprocess for streaming mock images continuously, mocking balparda_lib.QueueImages().
 
   Expects to be the entry point for a multiprocessing.Process() call. Will write to `queue`
   continuously until `stop_flag` becomes !=0 (True). The written images will be read from
-  `mock_images_glob` and retuned in a cycle.
+  `mock_images_glob` and retuned in a cycle. Like the real pipeline, if `queue` is bounded and
+  full, the oldest images in it are discarded.
 
   Args:
     queue: a multiprocessing.Queue object that will receive (n, img) tuples, where n is the
         image counter and img is the Nth imaging.Image object
-    stop_flag: a multiprocessing.Value('b', 0, lock=True) byte ('b' signed char) object that
+    stop_flag: a multiprocessing.Value('b', 0, lock=False) byte ('b' signed char) object that
         should start 0 (False) and become 1 (True) when the process should end.
     mock_images_glob: a glob string, like 'path/somefiles*.jpg' for example
     sleep_time: seconds to sleep between images
+    ring: (default None) If given, images are written to this ring and `queue` receives
+        (n, ticket) tuples instead, where ticket is the one returned by SharedImageRing.Put()
+    preload: (default True) If True, all images are decoded once, at the start, and kept in
+        memory; if False, they are decoded as needed (the next one while the current one is
+        being used), so only about 2 images are ever in memory, for large sets of large images
   """
   time.sleep(sleep_time)
-  images = [Image(p) for p in sorted(glob.glob(mock_images_glob))]
-  logging.info('Starting image MOCK pipeline with %d images', len(images))
-  for n, img in enumerate(itertools.cycle(images)):
+  paths = sorted(glob.glob(mock_images_glob))
+  images: Iterator[Image]
+  if preload:
+    images = itertools.cycle([Image(p) for p in paths])
+  else:
+    images = _DecodeAhead(itertools.cycle(paths))
+  logging.info('Starting image MOCK pipeline with %d images', len(paths))
+  dropped, debug = 0, logging.getLogger().isEnabledFor(logging.DEBUG)
+  for n, img in enumerate(images):
     if stop_flag.value:
       break
-    logging.debug('Mock image #%04d', n)
-    queue.put((n, img))
+    if debug:
+      logging.debug('Mock image #%04d', n)
+    dropped += lib.PutDiscardingOldest(queue, (n, img if ring is None else ring.Put(img)))
     time.sleep(sleep_time)
-  logging.info('Image MOCK pipeline stopped')
+  logging.info('Image MOCK pipeline stopped (%d stale images dropped)', dropped)
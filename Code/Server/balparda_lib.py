@@ -1,12 +1,16 @@
 """Balparda's utils lib."""
 
 import logging
+import math
 import multiprocessing
+import multiprocessing.queues
 import multiprocessing.sharedctypes
 # import pdb
+import os
+import queue as std_queue
 import time
 import sys
-from typing import Any, Callable
+from typing import Any, Callable, Optional, Union
 
 
 _LOG_FORMATS = (
@@ -17,6 +21,31 @@ _LOG_FORMATS = (
 # example '20220209.14:16:47.667    INFO[SomeMethodName]: Some message'
 
 
+class _CachedTimeFormatter(logging.Formatter):
+  """logging.Formatter that formats the date/time only once per second.
+
+  The milliseconds are added by the format string itself (see _LOG_FORMATS), so every record
+  logged in the same second shares the same formatted time, and time.strftime() + the local time
+  conversion run at most once per second instead of once per record.
+  """
+
+  def __init__(self, *args, **kwargs) -> None:
+    """Create formatter; same arguments as logging.Formatter."""
+    super().__init__(*args, **kwargs)
+    self._last = (-1, '')  # (second, formatted time), a single tuple so threads see both at once
+
+  def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+    """Return the creation time of `record` as a string, formatted by `datefmt`."""
+    if datefmt is None:
+      return super().formatTime(record)
+    second = int(record.created)
+    last_second, last_str = self._last
+    if second != last_second:
+      last_str = time.strftime(datefmt, self.converter(second))
+      self._last = (second, last_str)
+    return last_str
+
+
 def StartMultiprocessing(method: str = 'fork') -> None:
   """Start multiprocessing by setting up method.
 
@@ -42,7 +71,7 @@ def StartStdErrLogging(level: int = logging.INFO, logprocess: bool = False) -> N
   logger.setLevel(level)
   handler = logging.StreamHandler(sys.stdout)
   handler.setLevel(level)
-  formatter = logging.Formatter(
+  formatter = _CachedTimeFormatter(
       fmt=_LOG_FORMATS[1] if logprocess else _LOG_FORMATS[0],
       datefmt=_LOG_FORMATS[2])
   handler.setFormatter(formatter)
@@ -54,16 +83,16 @@ class Timer():
 
   def __init__(self) -> None:
     """Create context object."""
-    self._t = 0.0
+    self._t = 0  # time.monotonic_ns(): ns resolution, and not affected by clock (NTP) changes
 
   def __enter__(self) -> Any:
     """Enter context: get start time."""
-    self._t = time.time()
+    self._t = time.monotonic_ns()
     return self
 
   def __exit__(self, a, b, c) -> None:
     """Leave context: stop timer by printing value."""
-    logging.warning('Execution time: %0.2f seconds', time.time() - self._t)
+    logging.warning('Execution time: %0.2f seconds', (time.monotonic_ns() - self._t) / 1e9)
 
 
 def Timed(func: Callable):
@@ -85,82 +114,212 @@ def MinAngle(angle: int, allow_neg: bool = True) -> int:
   Returns:
     the `angle` reduced to either [-179,180] or [0,359], depending on `allow_neg`
   """
-  angle = ((int(angle) % 360) + 360) % 360  # guaranteed 0 <= angle <= 359
-  return angle if not allow_neg or angle <= 180 else (angle - 360)
+  angle = int(angle) % 360  # Python's % has the sign of the divisor, so 0 <= angle <= 359
+  return angle - 360 if allow_neg and angle > 180 else angle
+
+
+def SleepUntil(deadline: float, spin: float = 0.0) -> None:
+  """Sleep until `deadline`, a time.monotonic() time; returns at once if it has already passed.
+
+  Unlike a time.sleep(duration) after doing some work, this will not accumulate the time spent
+  on the work (or on oversleeping) when called repeatedly with increasing deadlines.
+
+  Args:
+    deadline: the time.monotonic() time to sleep until
+    spin: (default 0.0) If given, sleeps only until `spin` seconds before `deadline` and then
+        busy-waits the rest, trading that much CPU for less jitter than time.sleep() has
+        (a few ms on Linux); keep it small, like 0.002, and for short, infrequent waits
+  """
+  remaining = deadline - spin - time.monotonic()
+  while remaining > 0.0:
+    time.sleep(remaining)
+    remaining = deadline - spin - time.monotonic()
+  if spin:
+    now = time.monotonic
+    while now() < deadline:
+      pass
+
+
+def NextPeriodSlot(previous_slot: float, period: float) -> float:
+  """Return the next fixed-rate slot after `previous_slot`, skipping any slots already missed.
+
+  Args:
+    previous_slot: the time.monotonic() time of the last slot
+    period: the time between slots, in seconds
+
+  Returns:
+    the time.monotonic() time of the next slot in the future (or the immediate next one)
+  """
+  next_slot = previous_slot + period
+  late = time.monotonic() - next_slot
+  if late > 0.0:  # overran: drop the missed slots, so the rate never tries to "catch up"
+    next_slot += period * math.ceil(late / period)
+  return next_slot
+
+
+def SetRealtimePriority(priority: int) -> bool:
+  """Try to make this process SCHED_FIFO realtime with `priority`; needs Linux and privileges.
+
+  Returns:
+    True if it worked, False otherwise (it is not an error, the process just stays as it was)
+  """
+  try:
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))  # type: ignore
+  except (AttributeError, OSError) as err:
+    logging.warning('Could not set SCHED_FIFO priority %d: %s', priority, err)
+    return False
+  logging.info('Process set to SCHED_FIFO priority %d', priority)
+  return True
+
+
+def SetCpuAffinity(cpu: int) -> bool:
+  """Try to pin this process to a single `cpu` core, so it doesn't migrate; needs Linux.
+
+  Returns:
+    True if it worked, False otherwise (it is not an error, the process just stays as it was)
+  """
+  try:
+    os.sched_setaffinity(0, {cpu})  # type: ignore
+  except (AttributeError, OSError) as err:
+    logging.warning('Could not pin process to CPU %d: %s', cpu, err)
+    return False
+  logging.info('Process pinned to CPU %d', cpu)
+  return True
+
+
+def PutDiscardingOldest(queue: Union[multiprocessing.Queue, std_queue.Queue], obj: Any) -> int:
+  """Put `obj` into a bounded `queue` without blocking, discarding the oldest items if it is full.
+
+  Meant for producers that would rather drop stale items than have the consumer fall behind.
+  If `queue` is a multiprocessing.JoinableQueue or a queue.Queue (both of which track unfinished
+  tasks) the discarded items are marked as done.
+
+  Args:
+    queue: a multiprocessing.Queue or queue.Queue object created with a `maxsize`
+    obj: object to put in the queue
+
+  Returns:
+    number of items that were discarded to make room for `obj`
+  """
+  discarded = 0
+  while True:
+    try:
+      queue.put_nowait(obj)
+      return discarded
+    except std_queue.Full:
+      try:
+        queue.get_nowait()  # discard value
+      except std_queue.Empty:
+        time.sleep(0.001)  # the consumer got to it first, or it is still in the queue's pipe
+        continue
+      if isinstance(queue, (multiprocessing.queues.JoinableQueue, std_queue.Queue)):
+        queue.task_done()
+      discarded += 1
+
+
+_PICKUP_TIMEOUT = 0.1        # seconds, how often a waiting pipeline re-checks its stop flag
+_LOG_DROPPED_EVERY = 100      # tasks
 
 
 def UpToDateProcessingPipeline(input_queue: multiprocessing.JoinableQueue,
                                output_queue: multiprocessing.JoinableQueue,
                                process_call: Callable,
                                stop_flag: multiprocessing.sharedctypes.Synchronized,
-                               pipeline_name: str = '') -> None:
+                               pipeline_name: str = '',
+                               period: Optional[float] = None,
+                               realtime_priority: Optional[int] = None,
+                               cpu: Optional[int] = None) -> None:
   """Define a subprocess for processing continuously from `input_queue` to `output_queue`.
 
   Expects to be the entry point for a multiprocessing.Process() call. Will process items by
   calling `process_call()` continuously until `stop_flag` becomes !=0 (True). Will try to always
   keep up-to-date by skipping objects in `input_queue` if they come faster than the processing
-  is taking, i.e., NOT ALL objects in `input_queue` will be processed! Also, there CANNOT be
-  any other consumer of `input_queue` elements.
+  is taking, i.e., NOT ALL objects in `input_queue` will be processed! Also, this must be the
+  only process that takes objects out of `input_queue` for processing. The producers MAY take
+  objects out too, but only to discard them with PutDiscardingOldest(), that marks them done:
+  every object put gets exactly one task_done(), either from the producer that discarded it or
+  from here (when processed, drained as stale, or discarded at the end), so a join() on
+  `input_queue` still works.
 
-  multiprocessing.Queue.qsize() is said to be unreliable:
-  https://docs.python.org/3/library/multiprocessing.html#multiprocessing.Queue.qsize
-  but "supported" get_nowait()->raise and get(timeout=0.05) will not consistently extract all
-  queue elements.
+  Each pickup blocks on get() until there is an object and then drains the queue with
+  get_nowait(), keeping only the newest object. get_nowait() may miss an object that is still in
+  the queue's pipe (multiprocessing.Queue has a feeder thread), but it is only a tiny window and
+  that object will just be the one picked up next time; bounded queues (see PutDiscardingOldest())
+  keep the backlog small in the first place.
 
   Args:
     input_queue: a multiprocessing.Queue object to be read from; NOT ALL objects will be processed
     output_queue: a multiprocessing.Queue object to be writen to; can be `None` and then values
-        from `process_call()` will be discarded (i.e. this process will be the end of a pipeline)
+        from `process_call()` will be discarded (i.e. this process will be the end of a pipeline);
+        if it is bounded (has a `maxsize`) and full, its oldest results are discarded
     process_call: a method call that takes objects from `input_queue` type and returns objects of
-        `output_queue` type
-    stop_flag: a multiprocessing.Value('b', 0, lock=True) byte ('b' signed char) object that
+        `output_queue` type; if it returns `None` nothing is written to `output_queue`
+    stop_flag: a multiprocessing.Value('b', 0, lock=False) byte ('b' signed char) object that
         should start 0 (False) and become 1 (True) when the process should end.
     pipeline_name: (default '') If given, is a string process name, just for logging/debugging
+    period: (default None) If given, runs as a fixed-rate loop, processing at most one object
+        every `period` seconds, at regular slots; if some processing takes longer the missed
+        slots are dropped (and so are the objects that went stale meanwhile)
+    realtime_priority: (default None) If given, tries to make the process SCHED_FIFO realtime
+        with this priority (see SetRealtimePriority())
+    cpu: (default None) If given, tries to pin the process to this CPU core (see SetCpuAffinity())
   """
   pipeline_str = (' [%s]' % pipeline_name.strip()) if pipeline_name.strip() else ''
 
-  def _patient_discarding_pickup() -> Any:
-    # first wait for something in the queue by poling... remember to allow for stop flag
-    while not input_queue.qsize():
+  dropped = 0
+
+  def _latest_pickup() -> Any:
+    nonlocal dropped
+    # first wait (blocking, not polling) for something in the queue... allow for the stop flag
+    while True:
       if stop_flag.value:
         return None
-      time.sleep(0.005)
-    # we should have something, reduce size to 1
-    sz = input_queue.qsize()
-    while sz:
-      # we are going to asssume the queue has *at least* sz elements; first discard extra ones
-      if sz > 1:
-        logging.debug('Discarding %d tasks%s', sz - 1, pipeline_str)
-        for _ in range(sz - 1):
-          input_queue.get()  # discard value
-          input_queue.task_done()
-      # we *should* have only one left in queue
-      obj = input_queue.get()
-      sz = input_queue.qsize()
-      if sz:
-        # this probably means we had elements added while we waited; mark done and try again
-        logging.debug('Discarding 1 (tentative) task%s', pipeline_str)
-        input_queue.task_done()  # if we know the loop will try again, we have to discard
-    return obj
+      try:
+        obj = input_queue.get(timeout=_PICKUP_TIMEOUT)
+        break
+      except std_queue.Empty:
+        pass
+    # then drain it to the latest object: all the older ones are stale
+    while True:
+      try:
+        newer = input_queue.get_nowait()
+      except std_queue.Empty:
+        return obj
+      input_queue.task_done()  # the one we are discarding
+      obj = newer
+      dropped += 1
+      if not dropped % _LOG_DROPPED_EVERY:
+        logging.info('Discarded %d stale tasks so far%s', dropped, pipeline_str)
 
   # main loop of picking up tasks and working on them
   logging.info('Processing pipeline starting%s', pipeline_str)
-  n = 0
+  if cpu is not None:
+    SetCpuAffinity(cpu)
+  if realtime_priority is not None:
+    SetRealtimePriority(realtime_priority)
+  n, slot = 0, time.monotonic()
+  debug = logging.getLogger().isEnabledFor(logging.DEBUG)  # per-task logs are skipped right away
   try:
     while True:
-      task = _patient_discarding_pickup()
+      task = _latest_pickup()
       if task is None:
         break  # this means stop_flag.value is True, so exit
       try:
         if stop_flag.value:  # we might have gotten a stop flag during get()s
           break
-        logging.debug('Task #%04d is processing%s', n, pipeline_str)
+        if debug:
+          logging.debug('Task #%04d is processing%s', n, pipeline_str)
         result = process_call(task)
-        if output_queue is not None:
-          output_queue.put(result)
+        if output_queue is not None and result is not None:
+          discarded = PutDiscardingOldest(output_queue, result)  # plain put() if unbounded
+          if discarded and debug:
+            logging.debug('Discarded %d stale results%s', discarded, pipeline_str)
         n += 1
       finally:
         input_queue.task_done()
+      if period:
+        slot = NextPeriodSlot(slot, period)
+        SleepUntil(slot)
   finally:
     # we need to finish consuming the queue now
     time.sleep(0.3)  # helps make sure all objects have been inserted into input_queue
@@ -171,4 +330,5 @@ def UpToDateProcessingPipeline(input_queue: multiprocessing.JoinableQueue,
       input_queue.get()  # discard value
       input_queue.task_done()
     input_queue.close()
-    logging.info('Processing pipeline ending%s', pipeline_str)
+    logging.info('Processing pipeline ending%s (%d tasks done, %d stale discarded)',
+                 pipeline_str, n, dropped)
@@ -0,0 +1,169 @@
+"""Test Code/Server/balparda_imaging.py."""
+
+import glob
+import io
+import math
+import time
+
+import numpy as np  # type: ignore
+import pytest  # type: ignore
+
+from Code.Server import balparda_imaging as imaging
+
+
+_TEST_IMAGE = 'Code/Server/testimg/capture-001-000.jpg'
+_TEST_SHAPE = (600, 800, 3)
+_TEST_FOCUS_GLOB = 'Code/Server/testimg/capture-001-*.jpg'
+# full resolution BrightnessFocus() of the _TEST_FOCUS_GLOB images, in order, as computed by the
+# original implementation (a true scipy.ndimage.gaussian_filter() blur, no subsampling)
+_TEST_FOCI = [
+    (398.6, 295.4), (404.5, 294.5), (403.7, 286.0), (432.2, 255.0), (510.1, 216.8),
+    (100.6, 231.8), (109.1, 232.4), (112.7, 203.5), (373.9, 346.0), (357.4, 287.5),
+    (365.5, 238.8), (397.4, 199.0), (420.3, 204.4), (385.1, 220.2), (370.8, 229.5),
+    (362.7, 252.7), (357.8, 321.5), (311.2, 329.1), (319.3, 318.1), (326.2, 344.9),
+    (257.5, 423.8), (356.6, 408.4), (396.8, 404.5), (417.7, 400.9), (470.8, 384.0),
+    (496.8, 311.3),
+]
+
+
+def test_Image_Decode():
+  """Test Image() decodes from every type of encoded image it takes."""
+  with open(_TEST_IMAGE, 'rb') as file_obj:
+    data = file_obj.read()
+  expected = imaging.Image(_TEST_IMAGE)._img
+  assert expected.shape == _TEST_SHAPE
+  for img in (data, bytearray(data), memoryview(data),
+              io.BytesIO(data), io.BytesIO(data).getbuffer()):
+    pixels = imaging.Image(img)._img
+    assert pixels.dtype == np.uint8
+    assert pixels.flags['C_CONTIGUOUS']
+    assert np.array_equal(pixels, expected), type(img)
+
+
+def test_BufferReader():
+  """Test _BufferReader reads and seeks a buffer like a (read-only) file, as io.BytesIO does."""
+  data = bytes(range(256)) * 4
+  for buf, content in ((bytearray(data), data), (memoryview(data)[4:], data[4:])):
+    reader, expected = imaging._BufferReader(buf), io.BytesIO(content)
+    assert reader.read(10) == expected.read(10) and reader.tell() == 10
+    assert reader.seek(-5, io.SEEK_END) == expected.seek(-5, io.SEEK_END)
+    assert reader.read() == expected.read() and reader.read(3) == b''
+    assert reader.seek(7) == 7 and reader.seek(3, io.SEEK_CUR) == 10
+    assert reader.read(20) == content[10:30]
+    with pytest.raises(ValueError):
+      reader.seek(0, 5)
+
+
+def test_Image_Pixels():
+  """Test Image() keeps pixels as C-contiguous np.uint8, copying/converting only if needed."""
+  pixels = np.zeros(_TEST_SHAPE, dtype=np.uint8)
+  assert imaging.Image(pixels)._img is pixels  # already fine: not copied
+  strided = imaging.Image(pixels[::2, ::2])._img
+  assert strided.flags['C_CONTIGUOUS'] and strided.shape == (300, 400, 3)
+  for dtype in (np.uint16, np.int64, np.float32):
+    other = np.arange(256, dtype=dtype).reshape((16, 16))
+    converted = imaging.Image(other[::2])._img  # strided + converted in one copy
+    assert converted.dtype == np.uint8 and converted.flags['C_CONTIGUOUS']
+    assert np.array_equal(converted, np.arange(256, dtype=np.uint8).reshape((16, 16))[::2])
+
+
+def test_SharedImageRing():
+  """Test SharedImageRing Put()/Get()/Peek()/Valid()/CaptureTime(), wrapping around the ring."""
+  shape = (4, 6, 3)
+  images = [imaging.Image(np.full(shape, n, dtype=np.uint8)) for n in range(3)]
+  ring = imaging.SharedImageRing(shape, n_slots=2)
+  try:
+    before = time.monotonic()
+    tickets = [ring.Put(images[0]), ring.Put(images[1])]
+    assert [slot for slot, _ in tickets] == [0, 1]
+    for ticket, img in zip(tickets, images):
+      assert ring.Valid(ticket)
+      assert before <= ring.CaptureTime(ticket) <= time.monotonic()
+      assert np.array_equal(ring.Get(ticket)._img, img._img)
+      assert np.array_equal(ring.Peek(ticket)._img, img._img)
+    copy, view = ring.Get(tickets[0]), ring.Peek(tickets[0])
+    tickets.append(ring.Put(images[2]))  # wraps around: overwrites slot 0
+    assert tickets[2][0] == 0 and tickets[2] != tickets[0]
+    assert not ring.Valid(tickets[0])
+    assert ring.Get(tickets[0]) is None and ring.Peek(tickets[0]) is None
+    assert ring.CaptureTime(tickets[0]) is None
+    assert np.array_equal(copy._img, images[0]._img)  # the copy is safe...
+    assert np.array_equal(view._img, images[2]._img)  # ...the view is not
+    assert np.array_equal(ring.Get(tickets[2])._img, images[2]._img)
+    assert ring.Valid(tickets[1])  # the other slot is untouched
+    with pytest.raises(Exception, match='does not fit'):
+      ring.Put(imaging.Image(np.zeros((4, 5, 3), dtype=np.uint8)))
+  finally:
+    ring.Close()
+
+
+def test_SharedImageRing_TornRead():
+  """Test SharedImageRing.Get() detects a slot being written, before or while it copies it."""
+  shape = (4, 6, 3)
+  ring = imaging.SharedImageRing(shape, n_slots=2)
+  try:
+    ticket = ring.Put(imaging.Image(np.zeros(shape, dtype=np.uint8)))
+    slot, seq = ticket
+    ring._seq[slot] = seq + 1  # odd: the producer is writing the slot right now
+    assert ring.Get(ticket) is None and ring.Peek(ticket) is None
+    assert not ring.Valid(ticket) and ring.CaptureTime(ticket) is None
+    ring._seq[slot] = seq
+    assert ring.Get(ticket) is not None
+    pixels = ring._Pixels
+
+    def _OverwrittenWhileCopying(slot: int) -> np.ndarray:
+      ring._seq[slot] += 1  # the producer starts writing the slot right after Get() checked it
+      return pixels(slot)
+
+    ring._Pixels = _OverwrittenWhileCopying  # type: ignore
+    assert ring.Get(ticket) is None
+  finally:
+    ring.Close()
+  with pytest.raises(Exception, match='at least 2 slots'):
+    imaging.SharedImageRing(shape, n_slots=1)
+
+
+def test_PointToAngleMaker():
+  """Test PointToAngleMaker() calls give the same angles as PointToAngle()."""
+  dimensions, aov = (800, 600), (53.5, 41.41)
+  point_to_angle = imaging.PointToAngleMaker(dimensions, *aov)
+  points = [(0, 0), (400, 300), (799, 599), (123, 456), (800, 0)]
+  for x, y in points:
+    assert point_to_angle(x, y) == pytest.approx(imaging.PointToAngle(x, y, dimensions, *aov))
+  assert point_to_angle(400, 300) == pytest.approx((0.0, 0.0))  # the center
+  xs, ys = np.array(points).T  # also works for many points at once
+  for got, expected in zip(point_to_angle(xs, ys), imaging.PointToAngle(xs, ys, dimensions, *aov)):
+    assert got == pytest.approx(expected)
+
+
+def _FocusErrors(max_size):
+  """Distances, in pixels, from BrightnessFocus(max_size=max_size) to _TEST_FOCI."""
+  paths = sorted(glob.glob(_TEST_FOCUS_GLOB))
+  assert len(paths) == len(_TEST_FOCI)
+  return [math.hypot(x - x_expected, y - y_expected)
+          for (x, y), (x_expected, y_expected) in zip(
+              (imaging.Image(path).BrightnessFocus(max_size=max_size) for path in paths),
+              _TEST_FOCI)]
+
+
+def test_BrightnessFocus_FullResolution():
+  """Test the box blur BrightnessFocus() stays close to the gaussian one (measured: <4.4px)."""
+  assert max(_FocusErrors(None)) < 5.0
+
+
+def test_BrightnessFocus_Subsampled():
+  """Test the default (subsampled) BrightnessFocus() stays near _TEST_FOCI (measured: <7.3px)."""
+  assert max(_FocusErrors(imaging.Image._BRIGHTNESS_FOCUS_SIZE)) < 8.0
+
+
+def test_SharedImageRing_SeqWraps():
+  """Test SharedImageRing slot counters (32 bit, so they can't tear) keep working as they wrap."""
+  shape = (4, 6, 3)
+  ring = imaging.SharedImageRing(shape, n_slots=2)
+  try:
+    ring._seq[0] = 2**32 - 2  # even, about to wrap around
+    ticket = ring.Put(imaging.Image(np.full(shape, 7, dtype=np.uint8)))
+    assert ticket == (0, 0) and ring.Valid(ticket) and ring.CaptureTime(ticket) is not None
+    assert np.array_equal(ring.Get(ticket)._img, np.full(shape, 7, dtype=np.uint8))
+  finally:
+    ring.Close()
@@ -0,0 +1,52 @@
+"""Test Code/Server/balparda_lib.py."""
+
+import multiprocessing
+import queue as std_queue
+import threading
+import time
+
+import pytest  # type: ignore
+
+from Code.Server import balparda_lib as lib
+
+
+def _Joins(queue) -> bool:
+  """True if queue.join() returns in time (i.e. every item put got its task_done())."""
+  joiner = threading.Thread(target=queue.join, daemon=True)
+  joiner.start()
+  joiner.join(timeout=2.0)
+  return not joiner.is_alive()
+
+
+@pytest.mark.parametrize('make_queue', [std_queue.Queue, multiprocessing.JoinableQueue])
+def test_PutDiscardingOldest(make_queue):
+  """Test PutDiscardingOldest() keeps only the newest items, with task_done() balanced."""
+  queue = make_queue(maxsize=2)
+  assert [lib.PutDiscardingOldest(queue, n) for n in range(5)] == [0, 0, 1, 1, 1]
+  assert queue.get(timeout=1.0) == 3
+  assert queue.get(timeout=1.0) == 4
+  assert not _Joins(queue)  # the consumer did not mark the ones it got as done yet
+  queue.task_done()
+  queue.task_done()
+  assert _Joins(queue)  # the producer marked the 3 it discarded as done
+
+
+def test_NextPeriodSlot(monkeypatch):
+  """Test NextPeriodSlot() gives the next slot, or skips the ones already missed."""
+  monkeypatch.setattr(lib.time, 'monotonic', lambda: 10.125)  # all binary exact, no rounding
+  assert lib.NextPeriodSlot(10.0, 0.25) == 10.25    # on time
+  assert lib.NextPeriodSlot(9.0, 0.25) == 10.25     # missed 4 slots: skipped, no catching up
+  assert lib.NextPeriodSlot(9.875, 0.25) == 10.125  # the next one is right now
+  assert lib.NextPeriodSlot(5.0, 1.0) == 11.0       # is still in the same slot grid
+
+
+def test_SleepUntil():
+  """Test SleepUntil() returns at once for a past deadline and reaches a future one."""
+  start = time.monotonic()
+  lib.SleepUntil(start - 10.0)
+  lib.SleepUntil(start - 10.0, spin=0.002)
+  assert time.monotonic() - start < 0.05
+  for spin in (0.0, 0.002):
+    deadline = time.monotonic() + 0.05
+    lib.SleepUntil(deadline, spin=spin)
+    assert time.monotonic() >= deadline